@@ -1,4 +0,0 @@
-from ircradio.utils import liquidsoap_check_symlink
-
-
-liquidsoap_check_symlink()
@@ -0,0 +1,482 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import Awaitable, Callable, List
+from contextlib import AsyncExitStack
+import tempfile
+import logging
+import asyncio
+import random
+import shutil
+import time
+import os
+
+import settings
+from ircradio import metrics
+
+ARTISTS = 400
+WORDS = ["night", "city", "dream", "fire", "love", "blue", "summer", "echo", "gold", "rain",
+         "heart", "dance", "storm", "wild", "ocean", "star", "shadow", "light", "river", "moon",
+         "electric", "velvet", "neon", "paper", "silver", "ghost", "sugar", "thunder", "glass", "honey"]
+
+
+class Result(object):
+    def __init__(self, name: str, latencies: List[float], errors: int, elapsed: float, cpu: float = None):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.elapsed = elapsed
+        self.cpu = cpu  # process CPU seconds for all of them, if measured
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0
+        return self.latencies[min(len(self.latencies) - 1, int(len(self.latencies) * p))]
+
+    def __str__(self):
+        rate = len(self.latencies) / self.elapsed if self.elapsed else 0
+        cpu = f"{self.cpu * 1000 / len(self.latencies):>9.2f}" if self.cpu is not None and self.latencies else ""
+        return f"{self.name:<28} {len(self.latencies):>7} {self.errors:>6} {rate:>10.0f} " \
+               f"{self.percentile(.5) * 1000:>9.2f} {self.percentile(.99) * 1000:>9.2f} {cpu}"
+
+
+async def drive(name: str, func: Callable[[int], Awaitable], requests: int, concurrency: int) -> Result:
+    """call `func(i)` `requests` times from `concurrency` workers"""
+    latencies, errors = [], 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                await func(i)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return Result(name, latencies, errors, time.perf_counter() - started)
+
+
+class QueryCounter(logging.Handler):
+    """`with QueryCounter() as q:` counts SQL statements, all threads,
+    via peewee's debug log"""
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+        self._saved = None
+
+    def emit(self, record):
+        self.count += 1
+
+    def __enter__(self):
+        logger = logging.getLogger("peewee")
+        self._saved = logger.level, logger.propagate
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        logger.addHandler(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        logger = logging.getLogger("peewee")
+        logger.removeHandler(self)
+        logger.level, logger.propagate = self._saved
+
+
+def round_trips() -> int:
+    """LiquidSoap round trips so far; Radio.command and Radio.pipeline
+    observe one each"""
+    return sum(item[2] for item in metrics.liquidsoap_seconds.values.values())
+
+
+def synthetic_library(songs: int, directory: str, seed: int = 1) -> List[str]:
+    """`songs` rows plus empty files in `directory`; returns the filepaths"""
+    from ircradio.models import db, Song
+    rand = random.Random(seed)
+    rows, paths = [], []
+    for i in range(songs):
+        uid = f"b{i:010d}"
+        words = " ".join(rand.sample(WORDS, 3))
+        rows.append({
+            "utube_id": uid,
+            "title": f"Artist {rand.randrange(ARTISTS)} - {words} {i}",
+            "added_by": f"user{rand.randrange(50)}",
+            "duration": rand.randrange(120, 480),
+            "karma": rand.randrange(0, 11)
+        })
+        path = os.path.join(directory, f"{uid}.ogg")
+        open(path, "wb").close()
+        paths.append(path)
+
+    with db.atomic():
+        for i in range(0, len(rows), 500):
+            Song.insert_many(rows[i:i + 500]).execute()
+    return paths
+
+
+async def _queues_per_request() -> list:
+    """Radio.queues as it was before the lookups were batched: a round
+    trip per queued request and a query per file"""
+    from ircradio.database import AsyncSong
+    from ircradio.radio import Radio
+    queue = await Radio.command("requests.queue")
+    lines = [q for q in queue.split(b"\r\n") if q and q != b"END"]
+    paths = []
+    for rid in (lines[0].decode().split(" ") if lines else []):
+        meta = await Radio.command(f"request.metadata {rid}")
+        paths += Radio.filenames_from_strlist(meta.decode(errors="ignore").split("\n"))[:1]
+    songs = [await AsyncSong.from_filepath(fn) for fn in dict.fromkeys(paths)]
+
+    # now playing, from the history, also resolved per file
+    status = await Radio.command(f"{settings.liquidsoap_iface}.metadata")
+    history = Radio.filenames_from_strlist(status.decode(errors="ignore").split("\n"))[::-1][:5]
+    for fn in dict.fromkeys(history):
+        await AsyncSong.from_filepath(fn)
+    return songs
+
+
+async def queues_cost(liquidsoap, library: List[str], queued: int = 50, calls: int = 20):
+    """Round trips and SQL queries per Radio.queues() call. Run before
+    the pollers start, so nothing else talks to LiquidSoap or SQLite."""
+    from ircradio.radio import Radio
+    for _ in range(liquidsoap.HISTORY):
+        liquidsoap.skip()
+    for path in library[:queued]:
+        liquidsoap._push("requests", path)
+    for name, func in (("batched", Radio.queues), ("per request", _queues_per_request)):
+        trips = round_trips()
+        with QueryCounter() as queries:
+            for _ in range(calls):
+                await func()
+        print(f"Radio.queues, {queued} queued ({name}): {(round_trips() - trips) / calls:.0f} round trips, "
+              f"{queries.count / calls:.0f} queries per call")
+    for rid in liquidsoap.queues["requests"]:
+        liquidsoap.requests.pop(rid, None)
+    liquidsoap.queues["requests"].clear()
+
+
+async def fanout(liquidsoap, library: List[str], sessions: int, rounds: int = 20) -> List[Result]:
+    """Track changes pushed to `sessions` /ws sessions, subscribed
+    directly (no websocket server) with a consumer task each like the
+    /ws handler, against every session polling LiquidSoap itself as
+    /ws did before the shared producer"""
+    from ircradio import factory
+    from ircradio.radio import Radio
+    from ircradio.websockets import subscribe, unsubscribe, broadcast
+    subs = [subscribe() for _ in range(sessions)]
+    for session in subs:
+        while not session.queue.empty():
+            session.queue.get_nowait()
+
+    received = 0
+    everyone = asyncio.Event()
+
+    async def consume(session):
+        nonlocal received
+        while True:
+            await session.get()
+            received += 1
+            if received == sessions:
+                everyone.set()
+
+    async def wait_all(since: float) -> int:
+        try:
+            await asyncio.wait_for(everyone.wait(), 5)
+        except asyncio.TimeoutError:
+            return sessions - received
+        latencies.append(time.perf_counter() - since)
+        return 0
+
+    consumers = [asyncio.create_task(consume(s)) for s in subs]
+    results = []
+    try:
+        # track change: poll, snapshot, serialize once, fan out
+        latencies, errors = [], 0
+        trips = round_trips()
+        started, cpu = time.perf_counter(), time.process_time()
+        for r in range(rounds):
+            received = 0
+            everyone.clear()
+            liquidsoap._push("requests", library[r % len(library)])
+            liquidsoap.skip()
+            since = time.perf_counter()
+            factory.now_playing.poke()
+            errors += await wait_all(since)
+        results.append(Result(f"/ws track change ({sessions})", latencies, errors,
+                              time.perf_counter() - started, time.process_time() - cpu))
+        print(f"/ws producer: {(round_trips() - trips) / rounds:.1f} round trips per track change, "
+              f"{sessions} sessions (cpu ms includes the in-process fake LiquidSoap)")
+
+        # the fan-out alone
+        latencies, errors = [], 0
+        started, cpu = time.perf_counter(), time.process_time()
+        for r in range(rounds):
+            received = 0
+            everyone.clear()
+            since = time.perf_counter()
+            broadcast(f'{{"now_playing": "bench {r}"}}')
+            errors += await wait_all(since)
+        results.append(Result(f"/ws broadcast ({sessions})", latencies, errors,
+                              time.perf_counter() - started, time.process_time() - cpu))
+    finally:
+        for task in consumers:
+            task.cancel()
+        for session in subs:
+            unsubscribe(session)
+
+    latencies, errors, polls = [], 0, 3
+    trips = round_trips()
+    started, cpu = time.perf_counter(), time.process_time()
+    for _ in range(polls):
+        since = time.perf_counter()
+        polled = await asyncio.gather(*[Radio.history() for _ in range(sessions)], return_exceptions=True)
+        errors += sum(isinstance(p, Exception) for p in polled)
+        latencies.append(time.perf_counter() - since)
+    results.append(Result(f"/ws per-session poll ({sessions})", latencies, errors,
+                          time.perf_counter() - started, time.process_time() - cpu))
+    print(f"/ws per-session polling: {(round_trips() - trips) / polls:.0f} round trips per poll interval")
+    return results
+
+
+def _like(word: str) -> list:
+    from ircradio.models import Song
+    return list(Song.select().where(Song.title ** f"%{word}%"))
+
+
+async def loop_lag(searches: int = 40):
+    """Event loop lag while `searches` concurrent LIKE searches run on
+    the loop itself, as before the database executors, and on the
+    reader threads"""
+    from ircradio.database import read
+
+    async def on_loop(word: str):
+        _like(word)
+
+    async def on_readers(word: str):
+        await read(_like, word)
+
+    for name, func in (("on the loop", on_loop), ("reader threads", on_readers)):
+        lags, stop = [], False
+
+        async def monitor():
+            while not stop:
+                since = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lags.append(time.perf_counter() - since - 0.001)
+
+        task = asyncio.create_task(monitor())
+        await asyncio.sleep(0.01)
+        started = time.perf_counter()
+        await asyncio.gather(*[func(WORDS[i % len(WORDS)]) for i in range(searches)])
+        elapsed = time.perf_counter() - started
+        stop = True
+        await task
+        lags.sort()
+        print(f"loop lag, {searches} concurrent LIKE searches ({name}): max {lags[-1] * 1000:.1f} ms, "
+              f"p50 {lags[len(lags) // 2] * 1000:.1f} ms; {elapsed * 1000:.0f} ms for all searches")
+
+
+def rotation_cost(songs: int, picks: int = 1000, seed: int = 3):
+    """Rotation build/pick/update cost on `songs` in-memory tracks
+    (rows as Playlist.playable() returns them), against random.choices
+    over the full weight list; checks the no-repeat window and artist
+    separation over `picks` consecutive picks"""
+    from ircradio.scheduler import Rotation, artist
+    rand = random.Random(seed)
+    rows = [(f"r{i:010d}", f"Artist {rand.randrange(ARTISTS)} - {' '.join(rand.sample(WORDS, 3))} {i}",
+             f"user{rand.randrange(50)}", rand.randrange(0, 11)) for i in range(songs)]
+    rotation = Rotation(window=settings.autoplay_window, separation=settings.autoplay_separation)
+
+    started = time.perf_counter()
+    rotation.load(rows)
+    build = time.perf_counter() - started
+
+    started = time.perf_counter()
+    picked = [rotation.pick() for _ in range(picks)]
+    pick = (time.perf_counter() - started) / picks
+
+    votes = [(rows[rand.randrange(songs)][0], rand.randrange(0, 11)) for _ in range(picks)]
+    started = time.perf_counter()
+    for uid, karma in votes:
+        rotation.update(uid, karma)
+    update = (time.perf_counter() - started) / picks
+
+    weights = [Rotation.weight(r[3]) for r in rows]
+    population = range(songs)
+    started = time.perf_counter()
+    for _ in range(20):
+        rand.choices(population, weights)
+    choices = (time.perf_counter() - started) / 20
+
+    titles = {r[0]: r[1] for r in rows}
+    repeats = sum(uid in picked[max(0, i - rotation.window):i] for i, uid in enumerate(picked))
+    artists = [artist(titles[uid]) for uid in picked]
+    clashes = sum(a in artists[max(0, i - rotation.separation):i] for i, a in enumerate(artists))
+    print(f"rotation, {songs} songs: build {build * 1000:.0f} ms, pick {pick * 1e6:.1f} us, "
+          f"update {update * 1e6:.1f} us, random.choices {choices * 1000:.2f} ms per pick; "
+          f"{picks} picks: {repeats} repeats within {rotation.window}, "
+          f"{clashes} artist repeats within {rotation.separation}")
+
+
+async def autoplay_share(liquidsoap, rounds: int = 20, settle: float = 1):
+    """Skip through `rounds` tracks with no user requests and count how
+    many were karma picks from the `autoplay` queue rather than the
+    static playlist fallback"""
+    from ircradio import factory
+    picks = 0
+    for _ in range(rounds):
+        version = factory.now_playing.version
+        liquidsoap.skip()
+        picks += bool(liquidsoap.playing and liquidsoap.playing[0] == "autoplay")
+        factory.now_playing.poke()
+        try:
+            await factory.now_playing.wait_for_change(version, timeout=settle)
+        except asyncio.TimeoutError:
+            pass
+        # let the rotation top up
+        await asyncio.sleep(settle / 4)
+    print(f"autoplay: {picks}/{rounds} track changes were karma picks")
+
+
+class Channel(object):
+    """Discord channel stand-in for the Commands handlers"""
+    def __init__(self, _id: int = 1):
+        self.id = _id
+        self.sent = 0
+
+    async def send(self, content: str):
+        self.sent += 1
+
+
+async def run(songs: int = 10000, requests: int = 2000, concurrency: int = 16, clients: int = 200,
+              sessions: int = 3000, rotation_songs: int = 100000):
+    """Start the fakes, a web-if wired to them (no Discord login, no
+    yt-dlp) on a throwaway database, and drive the hot paths"""
+    import discord
+    from ircradio import factory
+    from ircradio.fakes import FakeLiquidSoap, FakeIceCast
+    from ircradio.models import db, PRAGMAS
+
+    tmp = tempfile.mkdtemp(prefix="ircradio-bench-")
+    settings.dir_music = os.path.join(tmp, "music")
+    settings.liquidsoap_playlist = os.path.join(tmp, "playlist.m3u")
+    settings.enable_search_route = True
+    settings.liquidsoap_poll_interval = 1
+    os.makedirs(settings.dir_music)
+    db.init(os.path.join(tmp, "bench.sqlite3"), pragmas=PRAGMAS)
+
+    app = factory.create_app()
+    await factory._setup_database(app)
+    factory.subsystems["database"] = "up"
+    started = time.perf_counter()
+    library = synthetic_library(songs, settings.dir_music)
+    print(f"synthetic library: {songs} songs in {time.perf_counter() - started:.1f}s")
+
+    liquidsoap = FakeLiquidSoap(library)
+    icecast = FakeIceCast(listeners=42)
+    await liquidsoap.start()
+    await icecast.start()
+    settings.liquidsoap_host, settings.liquidsoap_port = liquidsoap.host, liquidsoap.port
+    settings.icecast2_bind_host, settings.icecast2_bind_port = icecast.host, icecast.port
+
+    try:
+        await factory._setup_liquidsoap(app)
+        await factory._setup_http(app)
+        factory.user_agents = ["ircradio-bench"]
+        await factory._setup_bans(app)
+        await factory._setup_music_index(app)
+        await queues_cost(liquidsoap, library)
+        await factory._setup_playlist(app)
+        await factory._setup_now_playing(app)
+        await factory._setup_rotation(app)
+        await factory._setup_icecast_stats(app)
+        factory.discord_bot = discord.Client(intents=discord.Intents.none())
+        import ircradio.routes
+        from ircradio.disco import Commands
+
+        while not factory.now_playing.version:
+            await asyncio.sleep(0.05)
+
+        client = app.test_client()
+        rand = random.Random(2)
+        results = []
+
+        async def get(path: str, headers: dict = None, status: int = 200):
+            response = await client.get(path, headers=headers)
+            await response.get_data()
+            if response.status_code != status:
+                raise Exception(f"{path}: {response.status_code}")
+
+        async def search(i):
+            await get(f"/search?name={'+'.join(rand.sample(WORDS, rand.randrange(1, 3)))}")
+        results.append(await drive("GET /search", search, requests, concurrency))
+
+        async def search_cold(i):
+            ircradio.routes.search_cache.clear()
+            await search(i)
+        results.append(await drive("GET /search (uncached)", search_cold, requests, concurrency))
+
+        results.append(await drive("GET /history.txt", lambda i: get("/history.txt"), requests, concurrency))
+        response = await client.get("/history.txt")
+        etag = response.headers["ETag"]
+        results.append(await drive("GET /history.txt (304)", lambda i: get(
+            "/history.txt", headers={"If-None-Match": etag}, status=304), requests, concurrency))
+
+        channel = Channel()
+        commands = {
+            "!np": lambda i: Commands.np(target=channel, nick="bench"),
+            "!listeners": lambda i: Commands.listeners(target=channel, nick="bench"),
+            "!queue": lambda i: Commands.queue(target=channel, nick="bench"),
+            "!search": lambda i: Commands.search(rand.choice(WORDS), target=channel, nick="bench"),
+            "!tune": lambda i: Commands.tune(target=channel, nick=f"bench{i}"),
+        }
+        for name, func in commands.items():
+            results.append(await drive(name, func, requests, concurrency))
+
+        await loop_lag()
+        await autoplay_share(liquidsoap)
+        rotation_cost(rotation_songs)
+
+        # /ws: fan out of one track change to all clients
+        latencies, errors = [], 0
+        rounds = 20
+        started = time.perf_counter()
+        async with AsyncExitStack() as stack:
+            sockets = [await stack.enter_async_context(client.websocket("/ws")) for _ in range(clients)]
+            await asyncio.gather(*[ws.receive() for ws in sockets])  # current frame
+
+            async def receive(ws, since: float):
+                try:
+                    await asyncio.wait_for(ws.receive(), 5)
+                    latencies.append(time.perf_counter() - since)
+                except asyncio.TimeoutError:
+                    return 1
+                return 0
+
+            for r in range(rounds):
+                liquidsoap._push("requests", library[r])
+                liquidsoap.skip()
+                since = time.perf_counter()
+                factory.now_playing.poke()
+                errors += sum(await asyncio.gather(*[receive(ws, since) for ws in sockets]))
+        results.append(Result(f"/ws fan-out ({clients} clients)", latencies, errors,
+                              time.perf_counter() - started))
+        results += await fanout(liquidsoap, library, sessions)
+
+        print(f"{'':<28} {'n':>7} {'errors':>6} {'req/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'cpu ms':>9}")
+        for result in results:
+            print(result)
+        print(f"search cache: {ircradio.routes.search_cache.hits} hits, "
+              f"{ircradio.routes.search_cache.misses} misses; "
+              f"liquidsoap: {liquidsoap.commands} commands; icecast: {icecast.requests} requests")
+    finally:
+        if factory.liquidsoap:
+            await factory.liquidsoap.close()
+        if factory.http:
+            await factory.http.close()
+        await liquidsoap.stop()
+        await icecast.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
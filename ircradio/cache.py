@@ -0,0 +1,52 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import Hashable, Optional, Tuple
+from collections import OrderedDict
+import hashlib
+import time
+
+# bumped on every library change (songs added, removed,
+# renamed, voted on); cached responses from older
+# generations are never served.
+library_generation = 0
+
+
+def invalidate():
+    global library_generation
+    library_generation += 1
+
+
+class ResponseCache(object):
+    """In-process LRU/TTL cache of encoded response bodies + ETags"""
+    def __init__(self, maxsize: int = 1024, ttl: int = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Tuple[bytes, str]]:
+        item = self._data.get(key)
+        if item is not None:
+            generation, expires, body, etag = item
+            if generation == library_generation and expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return body, etag
+            del self._data[key]
+        self.misses += 1
+
+    def set(self, key: Hashable, body: bytes, generation: int) -> Tuple[bytes, str]:
+        """`generation`: library_generation as read *before* the query
+        that produced `body` started, so a query racing a write is
+        stored under the older generation and never served"""
+        etag = hashlib.sha1(body).hexdigest()[:16]
+        self._data[key] = (generation, time.monotonic() + self.ttl, body, etag)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return body, etag
+
+    def clear(self):
+        self._data.clear()
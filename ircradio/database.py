@@ -0,0 +1,168 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import functools
+import asyncio
+import os
+
+import settings
+from ircradio.models import Song, Ban, Play, FileMeta
+from ircradio.youtube import YouTube
+from ircradio.cache import invalidate
+from ircradio import metrics
+from ircradio.metrics import timed
+
+# SQLite in WAL mode: many concurrent readers, one writer.
+# peewee keeps a connection per thread.
+reader = ThreadPoolExecutor(max_workers=settings.db_readers, thread_name_prefix="db-read")
+writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+
+async def read(func, *args, **kwargs):
+    """run a (read-only) database call off the event loop"""
+    loop = asyncio.get_event_loop()
+    with timed(metrics.db_seconds, "read", func.__qualname__):
+        return await loop.run_in_executor(reader, functools.partial(func, *args, **kwargs))
+
+
+async def write(func, *args, **kwargs):
+    """run a database call that may write on the single writer thread"""
+    loop = asyncio.get_event_loop()
+    with timed(metrics.db_seconds, "write", func.__qualname__):
+        return await loop.run_in_executor(writer, functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    reader.shutdown(wait=False)
+    writer.shutdown(wait=True)
+
+
+class AsyncSong:
+    """Awaitable versions of the Song helpers"""
+    @staticmethod
+    async def search(needle: str, min_chars=3) -> List[Song]:
+        return await read(Song.search, needle, min_chars=min_chars)
+
+    @staticmethod
+    async def search_fts(needle: str, columns: List[str], limit: int = -1, offset: int = 0) -> Optional[List[Song]]:
+        return await read(Song.search_fts, needle, columns, limit=limit, offset=offset)
+
+    @staticmethod
+    async def library(added_by: str, order: str = "date", cursor: str = None,
+                      limit: int = 100) -> Tuple[List[Song], Optional[str]]:
+        return await read(Song.library, added_by, order=order, cursor=cursor, limit=limit)
+
+    @staticmethod
+    async def by_uid(uid: str) -> Optional[Song]:
+        return await read(Song.by_uid, uid)
+
+    @staticmethod
+    async def by_added_by(added_by: str) -> List[Song]:
+        return await read(lambda: list(Song.select().where(Song.added_by ** f"%{added_by}%")))
+
+    @staticmethod
+    async def from_filepath(filepath: str) -> Optional[Song]:
+        # may auto-create
+        return await write(Song.from_filepath, filepath)
+
+    @staticmethod
+    async def from_filepaths(filepaths: List[str]) -> List[Song]:
+        # may auto-create
+        return await write(Song.from_filepaths, filepaths)
+
+    @staticmethod
+    async def create(**kwargs) -> Song:
+        return await write(Song.create, **kwargs)
+
+    @staticmethod
+    async def save(song: Song):
+        return await write(song.save)
+
+    @staticmethod
+    async def rename(utube_id: str, title: str):
+        await write(lambda: Song.update(title=title).where(Song.utube_id == utube_id).execute())
+        invalidate()
+
+    @staticmethod
+    async def delete(utube_id: str):
+        await write(Song.delete_by_uid, utube_id)
+
+    @staticmethod
+    async def delete_song(utube_id: str) -> bool:
+        return await write(Song.delete_song, utube_id)
+
+    @staticmethod
+    async def vote(utube_id: str, nick: str, play_id: Optional[int], played_at: datetime,
+                   delta: int) -> Optional[int]:
+        return await write(Song.vote, utube_id, nick, play_id, played_at, delta)
+
+    @staticmethod
+    async def count() -> int:
+        return await read(Song.select().count)
+
+
+class AsyncBan:
+    """Awaitable versions of the Ban helpers"""
+    @staticmethod
+    async def all() -> List[str]:
+        return await read(lambda: [b.utube_id_or_nick for b in Ban.select()])
+
+    @staticmethod
+    async def create(utube_id_or_nick: str) -> Ban:
+        from ircradio.factory import bans
+        ban = await write(Ban.create, utube_id_or_nick=utube_id_or_nick)
+        bans.add(utube_id_or_nick)
+        invalidate()
+        return ban
+
+    @staticmethod
+    async def delete(utube_id_or_nick: str):
+        from ircradio.factory import bans
+        await write(lambda: Ban.delete().where(Ban.utube_id_or_nick == utube_id_or_nick).execute())
+        bans.discard(utube_id_or_nick)
+        invalidate()
+
+
+class AsyncPlay:
+    """Awaitable versions of the Play helpers"""
+    @staticmethod
+    async def record(song: Song, started_at: datetime, listeners: int = None) -> Optional[Play]:
+        return await write(Play.record, song, started_at, listeners)
+
+    @staticmethod
+    async def history(before: int = None, limit: int = 50) -> List[Play]:
+        return await read(Play.history, before=before, limit=limit)
+
+    @staticmethod
+    async def most_played(limit: int = 25) -> List[Song]:
+        return await read(Song.most_played, limit)
+
+    @staticmethod
+    async def count_by(added_by: str) -> int:
+        return await read(Play.count_by, added_by)
+
+
+class AsyncFileMeta:
+    @staticmethod
+    async def metadata(filepath: str) -> Optional[dict]:
+        """YouTube.metadata_from_filepath, with the cache lookup on a
+        reader, the parse in the default executor and the cache write
+        on the writer thread"""
+        loop = asyncio.get_event_loop()
+        try:
+            stat = await loop.run_in_executor(None, os.stat, filepath)
+        except OSError:
+            stat = None
+
+        if stat:
+            metadata = await read(FileMeta.lookup, filepath, mtime=stat.st_mtime, size=stat.st_size)
+            if metadata:
+                return metadata
+
+        metadata = await loop.run_in_executor(None, YouTube.parse_metadata, filepath)
+        if metadata and stat:
+            await write(FileMeta.store, filepath, mtime=stat.st_mtime, size=stat.st_size, metadata=metadata)
+        return metadata
@@ -1,5 +1,5 @@
-from typing import List, Optional
-import os
+from typing import List, Optional, Dict, Tuple
+from collections import deque
 import time
 import asyncio
 import random
@@ -9,29 +9,88 @@ import discord
 import settings
 from ircradio.radio import Radio
 from ircradio.youtube import YouTube
+from ircradio.database import AsyncSong
+from ircradio.models import Song
+from ircradio import metrics
+from ircradio.metrics import timed
 from ircradio.factory import discord_bot as bot
 
 
-msg_queue = asyncio.Queue()
+DISCORD_MAX_LENGTH = 2000
 
-async def message_worker():
-    from ircradio.factory import app
 
-    while True:
+class Outbox(object):
+    """Outbound messages, queued per channel. Consecutive lines for the
+    same channel are coalesced into as few messages as possible; rate
+    limits are handled by discord.py, which waits out 429s per route."""
+    def __init__(self):
+        self.queues: Dict[int, deque] = {}
+        self.sent = 0
+        self.latency: float = 0  # seconds from enqueue to sent, moving average
+
+    @property
+    def depth(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    def put(self, target, message: str):
+        key = getattr(target, "id", id(target))
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            asyncio.create_task(self._worker(key, target))
+        queue.append((message, time.monotonic()))
+
+    @staticmethod
+    def _take(queue: deque) -> Tuple[str, List[float]]:
+        """pop as many lines as fit in a single message"""
+        limit = DISCORD_MAX_LENGTH - len("```\n\n```")
+        lines, queued = [], []
+        length = 0
+        while queue:
+            msg, ts = queue[0]
+            msg = msg[:limit]
+            if lines and length + len(msg) + 1 > limit:
+                break
+            queue.popleft()
+            lines.append(msg)
+            queued.append(ts)
+            length += len(msg) + 1
+
+        if len(lines) == 1:
+            return f"`{lines[0]}`", queued
+        return "```\n" + "\n".join(lines) + "\n```", queued
+
+    async def _worker(self, key: int, target):
+        from ircradio.factory import app
+        queue = self.queues[key]
         try:
-            data: dict = await msg_queue.get()
-            target = data['target']
-            msg = data['message']
-            await target.send(f'`{msg}`')
-        except Exception as ex:
-            app.logger.error(f"message_worker(): {ex}")
-        await asyncio.sleep(0.3)
+            while queue:
+                content, queued = self._take(queue)
+                try:
+                    await target.send(content)
+                except Exception as ex:
+                    app.logger.error(f"outbox: {ex}")
+                    continue
+
+                now = time.monotonic()
+                for ts in queued:
+                    self.latency = self.latency * 0.9 + (now - ts) * 0.1
+                self.sent += 1
+        finally:
+            del self.queues[key]
+
+
+outbox = Outbox()
+metrics.Callback("ircradio_discord_outbox_depth", "Discord lines waiting to be sent", lambda: outbox.depth)
+metrics.Callback("ircradio_discord_outbox_latency_seconds", "Discord enqueue to sent, moving average",
+                 lambda: outbox.latency)
+metrics.Callback("ircradio_discord_messages_sent_total", "Discord messages sent", lambda: outbox.sent, type="counter")
 
 def start():
     bot.loop.create_task(bot.start(settings.discord_token))
 
 async def send_message(target: str, message: str):
-    await msg_queue.put({"target": target, "message": message})
+    outbox.put(target, message)
 
 @bot.event
 async def on_ready():
@@ -39,8 +98,7 @@ async def on_ready():
 
 @bot.event
 async def on_message(message):
-    from ircradio.factory import app
-    from ircradio.models import Ban
+    from ircradio.factory import app, bans
     if message.author == bot.user:
         return
 
@@ -54,16 +112,12 @@ async def on_message(message):
 
     msg = msg[len(settings.discord_command_prefix):]
 
-    try:
-        if message.author not in settings.discord_admins:
-            banned = Ban.select().filter(utube_id_or_nick=message.author).get()
-            if banned:
-                return
-    except:
-        pass
+    nick = str(message.author)
+    if nick in bans and nick not in settings.discord_admins:
+        return
 
     data = {
-        "nick": str(message.author),
+        "nick": nick,
         "target": message.channel
     }
 
@@ -78,7 +132,8 @@ async def on_message(message):
     if cmd in Commands.LOOKUP and hasattr(Commands, cmd):
         attr = getattr(Commands, cmd)
         try:
-            await attr(*spl, **data)
+            with timed(metrics.command_seconds, cmd, errors=metrics.command_errors):
+                await attr(*spl, **data)
         except Exception as ex:
             app.logger.error(f"message_worker(): {ex}")
             pass
@@ -88,7 +143,8 @@ class Commands:
     LOOKUP = ['np', 'tune', 'boo', 'request', 'dj',
               'skip', 'listeners', 'queue',
               'queue_user', 'pop', 'search', 'stats',
-              'rename', 'ban', 'whoami', 'hello', 'help']
+              'rename', 'ban', 'whoami', 'hello', 'help',
+              'downloads', 'cancel']
 
     @staticmethod
     async def help(*args, target=None, nick=None, **kwards):
@@ -105,7 +161,8 @@ class Commands:
     @staticmethod
     async def np(*args, target=None, nick=None, **kwargs):
         """current song"""
-        history = Radio.history()
+        from ircradio.factory import now_playing
+        history = now_playing.history
         if not history:
             return await send_message(target, f"Nothing is playing?!")
         song = history[0]
@@ -116,46 +173,57 @@ class Commands:
     @staticmethod
     async def tune(*args, target=None, nick=None, **kwargs):
         """upvote song"""
-        history = Radio.history()
-        if not history:
-            return await send_message(target, f"Nothing is playing?!")
-        song = history[0]
-
-        if song.karma <= 9:
-            song.karma += 1
-            song.save()
-
-        msg = f"Rating for \"{song.title}\" is {song.karma}/10 .. PARTY ON!!!!"
-        await send_message(target=target, message=msg)
+        song = await Commands._vote(target, nick, delta=1)
+        if song:
+            msg = f"Rating for \"{song.title}\" is {song.karma}/10 .. PARTY ON!!!!"
+            await send_message(target=target, message=msg)
 
     @staticmethod
     async def boo(*args, target=None, nick=None, **kwargs):
         """downvote song"""
-        history = Radio.history()
+        song = await Commands._vote(target, nick, delta=-1)
+        if song:
+            msg = f"Rating for \"{song.title}\" is {song.karma}/10 .. BOOO!!!!"
+            await send_message(target=target, message=msg)
+
+    @staticmethod
+    async def _vote(target, nick: str, delta: int) -> Optional[Song]:
+        from ircradio.factory import now_playing, rotation
+        history = now_playing.history
         if not history:
-            return await send_message(target, f"Nothing is playing?!")
+            await send_message(target, f"Nothing is playing?!")
+            return
         song = history[0]
 
-        if song.karma >= 1:
-            song.karma -= 1
-            song.save()
+        try:
+            karma = await AsyncSong.vote(song.utube_id, nick, now_playing.play_id, now_playing.started, delta)
+        except Song.DoesNotExist:
+            await send_message(target, f"{nick}: song not found: \"{song.title}\"")
+            return
+        if karma is None:
+            await send_message(target, f"{nick}: you already voted on \"{song.title}\"")
+            return
 
-        msg = f"Rating for \"{song.title}\" is {song.karma}/10 .. BOOO!!!!"
-        await send_message(target=target, message=msg)
+        # the now playing snapshot is what !np and the web-if read
+        song.karma = karma
+        if rotation:
+            rotation.update(song.utube_id, karma)
+        return song
 
     @staticmethod
     async def request(*args, target=None, nick=None, **kwargs):
         """request a song by title or YouTube id"""
-        from ircradio.models import Song
 
         if not args:
             send_message(target=target, message="usage: !request <id>")
 
+        from ircradio.factory import bans
         needle = " ".join(args)
         try:
-            songs = Song.search(needle)
+            songs = await AsyncSong.search(needle)
         except Exception as ex:
             return await send_message(target, f"{ex}")
+        songs = [s for s in songs if s.utube_id not in bans]
         if not songs:
             return await send_message(target, "Not found!")
 
@@ -168,19 +236,18 @@ class Commands:
 
         song = songs[0]
         msg = f"Added {song.title} to the queue"
-        Radio.queue(song)
+        await Radio.queue(song)
         return await send_message(target, msg)
 
     @staticmethod
     async def search(*args, target=None, nick=None, **kwargs):
         """search for a title"""
-        from ircradio.models import Song
 
         if not args:
             return await send_message(target=target, message="usage: !search <id>")
 
         needle = " ".join(args)
-        songs = Song.search(needle)
+        songs = await AsyncSong.search(needle)
         if not songs:
             return await send_message(target, "No song(s) found!")
 
@@ -196,36 +263,69 @@ class Commands:
     @staticmethod
     async def dj(*args, target=None, nick=None, **kwargs):
         """add (or remove) a YouTube ID to the radiostream"""
-        from ircradio.models import Song
         if not args or args[0] not in ["-", "+"]:
             return await send_message(target, "usage: dj+ <youtube_id>")
 
+        from ircradio.factory import bans
         add: bool = args[0] == "+"
         utube_id = args[1]
         if not YouTube.is_valid_uid(utube_id):
             return await send_message(target, "YouTube ID not valid.")
 
         if add:
+            from ircradio.downloads import schedule
+            if utube_id in bans:
+                return await send_message(target, "YouTube ID is banned.")
             try:
-                await send_message(target, f"Scheduled download for '{utube_id}'")
-                song = await YouTube.download(utube_id, added_by=nick)
-                await send_message(target, f"'{song.title}' added")
+                job, created = await schedule(utube_id, added_by=nick, target=target)
             except Exception as ex:
                 return await send_message(target, f"Download '{utube_id}' failed; {ex}")
+            if created:
+                await send_message(target, f"Scheduled download for '{utube_id}'")
+            else:
+                await send_message(target, f"Already scheduled: {job}")
         else:
             try:
-                Song.delete_song(utube_id)
+                await AsyncSong.delete_song(utube_id)
                 await send_message(target, "Press F to pay respects.")
             except Exception as ex:
                 await send_message(target, f"Failed to remove {utube_id}; {ex}")
 
+    @staticmethod
+    async def downloads(*args, target=None, nick=None, **kwargs):
+        """show pending downloads, or the status of one YouTube ID"""
+        from ircradio.downloads import status
+        jobs = status(args[0] if args else None)
+        if not jobs:
+            return await send_message(target, "no downloads")
+
+        for job in jobs[:10]:
+            await send_message(target, str(job))
+
+    @staticmethod
+    async def cancel(*args, target=None, nick=None, **kwargs):
+        """cancel a pending download"""
+        from ircradio.downloads import status, cancel
+        if not args:
+            return await send_message(target, "usage: !cancel <youtube_id>")
+
+        jobs = [j for j in status(args[0]) if j.status in ["pending", "downloading"]]
+        if not jobs:
+            return await send_message(target, "No such download.")
+
+        if jobs[0].added_by != nick and nick not in settings.discord_admins:
+            return await send_message(target, "You may only cancel your own downloads.")
+
+        await cancel(args[0])
+        await send_message(target, f"Download '{args[0]}' cancelled.")
+
     @staticmethod
     async def skip(*args, target=None, nick=None, **kwargs):
         """skips current song"""
         from ircradio.factory import app
 
         try:
-            Radio.skip()
+            await Radio.skip()
         except Exception as ex:
             app.logger.error(f"{ex}")
             return await send_message(target=target, message="Error")
@@ -253,7 +353,7 @@ class Commands:
     async def queue(*args, target=None, nick=None, **kwargs):
         """show currently queued tracks"""
         from ircradio.models import Song
-        q: List[Song] = Radio.queues()
+        q: List[Song] = await Radio.queues()
         if not q:
             return await send_message(target, "queue empty")
 
@@ -261,11 +361,10 @@ class Commands:
             await send_message(target, f"{s.utube_id} | {s.title}")
             if i >= 12:
                 await send_message(target, "And some more...")
+                break
 
     @staticmethod
     async def rename(*args, target=None, nick=None, **kwargs):
-        from ircradio.models import Song
-
         try:
             utube_id = args[0]
             title = " ".join(args[1:])
@@ -275,17 +374,17 @@ class Commands:
             return await send_message(target, "usage: !rename <id> <new title>")
 
         try:
-            song = Song.select().where(Song.utube_id == utube_id).get()
+            song = await AsyncSong.by_uid(utube_id)
             if not song:
                 raise Exception("Song not found")
         except Exception as ex:
             return await send_message(target, "Song not found.")
 
-        if song.added_by != nick and nick not in settings.irc_admins_nicknames:
+        if song.added_by != nick and nick not in settings.discord_admins:
             return await send_message(target, "You may only rename your own songs.")
 
         try:
-            Song.update(title=title).where(Song.utube_id == utube_id).execute()
+            await AsyncSong.rename(utube_id, title)
         except Exception as ex:
             return await send_message(target, "Rename failure.")
 
@@ -294,19 +393,20 @@ class Commands:
     @staticmethod
     async def queue_user(*args, target=None, nick=None, **kwargs):
         """queue random song by username"""
-        from ircradio.models import Song
-
+        from ircradio.factory import bans
         added_by = args[0]
         try:
-            q = Song.select().where(Song.added_by ** f"%{added_by}%")
-            songs = [s for s in q]
+            songs = await AsyncSong.by_added_by(added_by)
+            songs = [s for s in songs if s.utube_id not in bans]
+            if not songs:
+                raise Exception("no songs")
         except:
             return await send_message(target, "No results.")
 
         for i in range(0, 5):
             song = random.choice(songs)
 
-            if Radio.queue(song):
+            if await Radio.queue(song):
                 return await send_message(target, f"A random {added_by} has appeared in the queue: {song.title}")
 
         await send_message(target, "queue_user exhausted!")
@@ -314,26 +414,21 @@ class Commands:
     @staticmethod
     async def stats(*args, target=None, nick=None, **kwargs):
         """random stats"""
-        songs = 0
-        try:
-            from ircradio.models import db
-            cursor = db.execute_sql('select count(*) from song;')
-            res = cursor.fetchone()
-            songs = res[0]
-        except:
-            pass
-
-        disk = os.popen(f"du -h {settings.dir_music}").read().split("\t")[0]
-        await send_message(target, f"Songs: {songs} | Disk: {disk}")
+        from ircradio.stats import summary
+        from ircradio.utils import human_bytes
+        stats = await summary()
+        hours = stats['duration'] // 3600
+        await send_message(target, f"Songs: {stats['songs']} | Disk: {human_bytes(stats['bytes'])} | "
+                                   f"Duration: {hours}h | Submitters: {len(stats['submitters'])}")
 
     @staticmethod
     async def ban(*args, target=None, nick=None, **kwargs):
         """add (or remove) a YouTube ID ban (admins only)"""
-        if nick not in settings.irc_admins_nicknames:
+        if nick not in settings.discord_admins:
             await send_message(target, "You need to be an admin.")
             return
 
-        from ircradio.models import Song, Ban
+        from ircradio.database import AsyncBan
         if not args or args[0] not in ["-", "+"]:
             return await send_message(target, "usage: ban+ <youtube_id or nickname>")
 
@@ -344,9 +439,9 @@ class Commands:
             return await send_message(target, "usage: ban+ <youtube_id or nickname>")
 
         if add:
-            Ban.create(utube_id_or_nick=arg)
+            await AsyncBan.create(arg)
         else:
-            Ban.delete().where(Ban.utube_id_or_nick == arg).execute()
+            await AsyncBan.delete(arg)
             await send_message(target, "Redemption")
 
     @staticmethod
@@ -0,0 +1,147 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import Dict, List, Optional, Tuple
+from collections import deque
+import asyncio
+import time
+
+from ircradio.database import read, write
+from ircradio.models import Download
+from ircradio.youtube import YouTube
+from ircradio import metrics
+
+# utube_id -> job, pending or in progress
+jobs: Dict[str, 'DownloadJob'] = {}
+# recently finished jobs, for status queries
+finished = deque(maxlen=25)
+
+
+class DownloadJob(object):
+    def __init__(self, utube_id: str, added_by: str, target=None, channel_id: int = None):
+        self.utube_id = utube_id
+        self.added_by = added_by
+        self.target = target
+        self.channel_id = channel_id if channel_id else getattr(target, "id", None)
+        self.status = "pending"  # downloading, done, failed, cancelled
+        self.progress: float = 0
+        self.error: Optional[str] = None
+        self.song = None
+        self.task: Optional[asyncio.Task] = None
+        self.date_added = time.time()
+
+    def set_progress(self, progress: float):
+        self.progress = progress
+
+    def __str__(self):
+        if self.status == "downloading":
+            return f"{self.utube_id} | downloading {self.progress:.0f}% (by {self.added_by})"
+        if self.status == "failed":
+            return f"{self.utube_id} | failed: {self.error}"
+        if self.status == "done" and self.song:
+            return f"{self.utube_id} | done: {self.song.title}"
+        return f"{self.utube_id} | {self.status} (by {self.added_by})"
+
+
+async def schedule(utube_id: str, added_by: str, target=None, channel_id: int = None,
+                   persist=True) -> Tuple[DownloadJob, bool]:
+    """Queue a download, returns (job, created). Requests for an id
+    that is already pending/downloading return the existing job."""
+    from ircradio.factory import download_queue
+    if utube_id in jobs:
+        return jobs[utube_id], False
+
+    job = DownloadJob(utube_id, added_by=added_by, target=target, channel_id=channel_id)
+    jobs[utube_id] = job
+    if persist:
+        await write(lambda: Download.insert(
+            utube_id=utube_id, added_by=added_by, channel_id=job.channel_id
+        ).on_conflict_ignore().execute())
+    await download_queue.put(job)
+    return job, True
+
+
+def status(utube_id: str = None) -> List[DownloadJob]:
+    if utube_id:
+        if utube_id in jobs:
+            return [jobs[utube_id]]
+        return [j for j in finished if j.utube_id == utube_id][-1:]
+    return list(jobs.values())
+
+
+async def cancel(utube_id: str) -> bool:
+    job = jobs.get(utube_id)
+    if not job:
+        return False
+
+    job.status = "cancelled"
+    if job.task:
+        job.task.cancel()
+    else:
+        # still in the queue, the worker will skip it
+        await _finish(job)
+    return True
+
+
+async def _finish(job: DownloadJob):
+    if jobs.get(job.utube_id) is job:
+        del jobs[job.utube_id]
+    finished.append(job)
+    await write(lambda: Download.delete().where(Download.utube_id == job.utube_id).execute())
+
+
+async def _notify(job: DownloadJob):
+    from ircradio.factory import discord_bot
+    if not job.target and job.channel_id and discord_bot:
+        job.target = discord_bot.get_channel(job.channel_id)
+    if not job.target:
+        return
+
+    from ircradio.disco import send_message
+    if job.status == "done":
+        await send_message(job.target, f"'{job.song.title}' added")
+    elif job.status == "failed":
+        await send_message(job.target, f"Download '{job.utube_id}' failed; {job.error}")
+
+
+async def worker():
+    from ircradio.factory import app, download_queue
+    while True:
+        job: DownloadJob = await download_queue.get()
+        if job.status == "cancelled":
+            continue
+
+        job.status = "downloading"
+        job.task = asyncio.create_task(
+            YouTube.download(job.utube_id, added_by=job.added_by, progress=job.set_progress))
+        await asyncio.wait([job.task])
+
+        if job.task.cancelled():
+            job.status = "cancelled"
+        elif job.task.exception():
+            job.status = "failed"
+            job.error = str(job.task.exception())
+        else:
+            job.status = "done"
+            job.song = job.task.result()
+        job.task = None
+        metrics.downloads.inc(job.status)
+
+        try:
+            await _finish(job)
+            await _notify(job)
+        except Exception as ex:
+            app.logger.error(f"download worker: {ex}")
+
+
+metrics.Callback("ircradio_downloads_pending", "Downloads queued or in progress", lambda: len(jobs))
+
+
+async def restore():
+    """re-queue jobs that were pending when we last shut down"""
+    from ircradio.factory import app
+    pending = await read(lambda: list(Download.select().order_by(Download.date_added)))
+    for row in pending:
+        await schedule(row.utube_id, added_by=row.added_by, channel_id=row.channel_id, persist=False)
+    if pending:
+        app.logger.info(f"restored {len(pending)} pending download(s)")
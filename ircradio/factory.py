@@ -1,34 +1,52 @@
 # SPDX-License-Identifier: BSD-3-Clause
 # Copyright (c) 2021, dsc@xmr.pm
 
-from typing import List, Optional
+from typing import Dict, List, Optional, Set
 import os
+import time
 import logging
 import asyncio
+import importlib
 
-import discord
+import aiohttp
 from quart import Quart
 
 import settings
 from ircradio.radio import Radio
-from ircradio.utils import print_banner
+from ircradio.liquidsoap import LiquidSoapClient
+from ircradio.nowplaying import NowPlaying
+from ircradio.icecast import IceCastStats
+from ircradio.library import MusicIndex, Playlist
+from ircradio.scheduler import Rotation
+from ircradio.utils import print_banner, http_session
 from ircradio.youtube import YouTube
 import ircradio.models
 
 app = None
 user_agents: List[str] = None
 websocket_sessions = set()
+bans: Set[str] = set()  # nicknames and YouTube IDs
 download_queue = asyncio.Queue()
 discord_bot = None
+liquidsoap: LiquidSoapClient = None
+http: aiohttp.ClientSession = None
+now_playing: NowPlaying = None
+icecast_stats: IceCastStats = None
+music_index: MusicIndex = None
+playlist: Playlist = None
+rotation: Rotation = None
 soap = Radio()
 # icecast2 = IceCast2()
+started = time.time()
+# startup phase -> "starting", "up", "failed: ..." or "blocked: ..."; see /readyz
+subsystems: Dict[str, str] = {}
 
 
-async def download_thing():
-    global download_queue
-
-    a = await download_queue.get()
-    e = 1
+async def _setup_downloads(app: Quart):
+    from ircradio.downloads import worker, restore
+    for _ in range(settings.download_workers):
+        asyncio.create_task(worker())
+    await restore()
 
 
 async def _setup_icecast2(app: Quart):
@@ -36,33 +54,161 @@ async def _setup_icecast2(app: Quart):
     await icecast2.write_config()
 
 
-async def _setup_database(app: Quart):
+def _init_database():
     import peewee
+    ircradio.models.migrate()
     models = peewee.Model.__subclasses__()
     for m in models:
         m.create_table()
 
+    from ircradio.models import Song
+    Song.setup_fts()
+
+
+async def _setup_database(app: Quart):
+    # on the writer thread, the FTS backfill can take a while
+    from ircradio.database import write
+    await write(_init_database)
+
+
+async def _setup_bans(app: Quart):
+    from ircradio.database import AsyncBan
+    bans.update(await AsyncBan.all())
+
 
 async def _setup_discord(app: Quart):
     global discord_bot
     loop = asyncio.get_event_loop()
+    # heavy import, keep it off the event loop
+    discord = await loop.run_in_executor(None, importlib.import_module, "discord")
     discord_bot = discord.Client(loop=loop)
-    from ircradio.disco import start, message_worker
+    from ircradio.disco import start
     start()
 
-    asyncio.create_task(message_worker())
-
 
 async def _setup_user_agents(app: Quart):
     global user_agents
-    with open(os.path.join(settings.cwd, 'data', 'agents.txt'), 'r') as f:
-        user_agents = [l.strip() for l in f.readlines() if l.strip()]
 
+    def _read():
+        with open(os.path.join(settings.cwd, 'data', 'agents.txt'), 'r') as f:
+            return [l.strip() for l in f.readlines() if l.strip()]
+    user_agents = await asyncio.get_event_loop().run_in_executor(None, _read)
+
+
+async def _setup_liquidsoap(app: Quart):
+    global liquidsoap
+    liquidsoap = LiquidSoapClient(
+        host=settings.liquidsoap_host,
+        port=settings.liquidsoap_port,
+        pool_size=settings.liquidsoap_pool_size,
+        timeout=settings.liquidsoap_timeout)
+
+
+async def _setup_http(app: Quart):
+    global http
+    http = http_session()
+
+
+async def _setup_music_index(app: Quart):
+    global music_index
+    music_index = MusicIndex(settings.dir_music, interval=settings.dir_music_scan_interval)
+    await music_index.scan()
+    asyncio.create_task(music_index.run())
+
+
+async def _setup_playlist(app: Quart):
+    global playlist
+    playlist = Playlist(settings.liquidsoap_playlist)
+    asyncio.create_task(playlist.run())
+
+
+async def _setup_now_playing(app: Quart):
+    global now_playing
+    now_playing = NowPlaying(interval=settings.liquidsoap_poll_interval)
+    asyncio.create_task(now_playing.run())
+
+    from ircradio.websockets import producer
+    asyncio.create_task(producer())
+
+    from ircradio.history import renderer
+    asyncio.create_task(renderer())
 
-async def _setup_requirements(app: Quart):
-    ls_reachable = soap.liquidsoap_reachable()
-    if not ls_reachable:
-        raise Exception("liquidsoap is not running, please start it first")
+
+async def _setup_rotation(app: Quart):
+    global rotation
+    rotation = Rotation(
+        window=settings.autoplay_window,
+        separation=settings.autoplay_separation,
+        queue_size=settings.autoplay_queue_size,
+        interval=settings.liquidsoap_poll_interval)
+    asyncio.create_task(rotation.run())
+
+
+async def _setup_loudness(app: Quart):
+    from ircradio import loudness
+    loudness.start_pool(settings.loudness_workers)
+
+
+async def _setup_library_stats(app: Quart):
+    from ircradio.stats import reconciler
+    asyncio.create_task(reconciler(settings.stats_reconcile_interval))
+
+
+async def _setup_icecast_stats(app: Quart):
+    global icecast_stats
+    icecast_stats = IceCastStats(
+        interval=settings.icecast2_stats_interval,
+        downsample=settings.icecast2_stats_downsample)
+    asyncio.create_task(icecast_stats.run())
+
+
+# name -> (setup, phases it needs); independent phases run concurrently
+PHASES = {
+    "database": (_setup_database, ()),
+    "user_agents": (_setup_user_agents, ()),
+    "discord": (_setup_discord, ("bans", "now_playing")),
+    "bans": (_setup_bans, ("database",)),
+    "music_index": (_setup_music_index, ("database",)),
+    "playlist": (_setup_playlist, ("music_index",)),
+    "now_playing": (_setup_now_playing, ("database",)),
+    "rotation": (_setup_rotation, ("playlist", "now_playing")),
+    "icecast_stats": (_setup_icecast_stats, ("database", "user_agents")),
+    "library_stats": (_setup_library_stats, ("database",)),
+    "loudness": (_setup_loudness, ()),
+    "downloads": (_setup_downloads, ("database", "bans", "loudness")),
+}
+
+
+async def _boot(app: Quart):
+    """Run the startup phases in dependency order while the web-if is
+    already serving; progress is kept in `subsystems`"""
+    tasks: Dict[str, asyncio.Task] = {}
+
+    async def phase(name: str):
+        setup, needs = PHASES[name]
+        subsystems[name] = "starting"
+        await asyncio.gather(*[tasks[n] for n in needs])
+        failed = [n for n in needs if subsystems[n] != "up"]
+        if failed:
+            subsystems[name] = f"blocked: {', '.join(failed)}"
+            return
+        started_at = time.perf_counter()
+        try:
+            await setup(app)
+        except Exception as ex:
+            subsystems[name] = f"failed: {ex}"
+            app.logger.error(f"startup: {name}: {ex}")
+            return
+        subsystems[name] = "up"
+        app.logger.info(f"startup: {name} up in {time.perf_counter() - started_at:.2f}s")
+
+    for name in PHASES:
+        tasks[name] = asyncio.ensure_future(phase(name))
+    await asyncio.gather(*tasks.values())
+    app.logger.info(f"startup: done in {time.time() - started:.2f}s")
+
+    from ircradio.youtube import YouTube
+    asyncio.create_task(YouTube.update_loop())
 
 
 def create_app():
@@ -72,15 +218,26 @@ def create_app():
 
     @app.before_serving
     async def startup():
-        await _setup_requirements(app)
-        await _setup_database(app)
-        await _setup_user_agents(app)
-        await _setup_discord(app)
+        # serve right away, /readyz reports when the rest is up
+        await _setup_liquidsoap(app)
+        await _setup_http(app)
         import ircradio.routes
-
-        from ircradio.youtube import YouTube
-        asyncio.create_task(YouTube.update_loop())
+        asyncio.create_task(_boot(app))
 
         print_banner()
 
+    @app.after_serving
+    async def shutdown():
+        if liquidsoap:
+            await liquidsoap.close()
+        if http:
+            await http.close()
+
+        from ircradio import loudness
+        if loudness.pool:
+            loudness.pool.shutdown(wait=False, cancel_futures=True)
+
+        from ircradio.database import shutdown
+        shutdown()
+
     return app
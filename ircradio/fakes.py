@@ -0,0 +1,163 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import Dict, List, Optional
+from collections import deque
+import asyncio
+import random
+
+from aiohttp import web
+
+import settings
+
+
+class FakeLiquidSoap(object):
+    """Stand-in for the LiquidSoap telnet control port, enough for the
+    web-if: request queues (`requests`, `autoplay`), request metadata,
+    the output's on-air history and skip. Plays random tracks from
+    `library` when the queues are empty. Like request.queue, a request
+    stays at the head of its queue while it plays."""
+    HISTORY = 10
+
+    def __init__(self, library: List[str], host: str = "127.0.0.1", port: int = 0,
+                 iface: str = None, track_seconds: float = 0):
+        self.library = library
+        self.host = host
+        self.port = port
+        self.iface = iface or settings.liquidsoap_iface
+        self.track_seconds = track_seconds
+        self.queues: Dict[str, deque] = {"requests": deque(), "autoplay": deque()}
+        self.requests: Dict[int, str] = {}  # rid -> filename
+        self.history = deque(maxlen=self.HISTORY)  # on-air, oldest first
+        self.rid = 0
+        self.playing: Optional[tuple] = None  # (queue, rid)
+        self.commands = 0
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._ticker: Optional[asyncio.Task] = None
+
+    def _push(self, queue: str, uri: str) -> int:
+        self.rid += 1
+        self.requests[self.rid] = uri
+        self.queues.setdefault(queue, deque()).append(self.rid)
+        return self.rid
+
+    def skip(self):
+        """advance to the next track"""
+        if self.playing:
+            name, rid = self.playing
+            if self.queues[name] and self.queues[name][0] == rid:
+                self.queues[name].popleft()
+            self.requests.pop(rid, None)
+            self.playing = None
+
+        for name in ("requests", "autoplay"):
+            if self.queues[name]:
+                rid = self.queues[name][0]
+                filename = self.requests[rid]
+                self.playing = (name, rid)
+                break
+        else:
+            filename = random.choice(self.library) if self.library else None
+        if filename:
+            self.history.append(filename)
+
+    def _metadata(self, filename: str) -> str:
+        # like LiquidSoap: \n between metadata lines, \r\n before END
+        return f'filename="{filename}"\nsource="{self.iface}"\nstatus="playing"'
+
+    def handle(self, line: str) -> str:
+        self.commands += 1
+        cmd, _, arg = line.strip().partition(" ")
+        name, _, action = cmd.rpartition(".")
+        if cmd == "help":
+            return "Available commands:\r\n| help\r\n| request.metadata <rid>\r\n" + \
+                "".join(f"| {q}.push <uri>\r\n| {q}.queue\r\n" for q in self.queues) + \
+                f"| {self.iface}.metadata\r\n| {self.iface}.skip"
+        if cmd == "request.metadata":
+            filename = self.requests.get(int(arg)) if arg.isdigit() else None
+            return self._metadata(filename) if filename else "No such request."
+        if cmd == f"{self.iface}.metadata":
+            items = list(self.history)
+            return "\n".join(f"--- {len(items) - i} ---\n{self._metadata(fn)}"
+                               for i, fn in enumerate(items))
+        if cmd == f"{self.iface}.skip":
+            self.skip()
+            return "Done"
+        if action == "push" and name in self.queues:
+            return str(self._push(name, arg))
+        if action == "queue" and name in self.queues:
+            return " ".join(str(rid) for rid in self.queues[name])
+        if cmd == "playlist.reload":
+            return "OK"
+        return 'ERROR: unknown command, type "help" to get a list of commands.'
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode(errors="ignore").strip()
+                if line in ("quit", "exit"):
+                    writer.write(b"Bye!\r\n")
+                    break
+                writer.write(f"{self.handle(line)}\r\nEND\r\n".encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _tick(self):
+        while True:
+            await asyncio.sleep(self.track_seconds)
+            self.skip()
+
+    async def start(self):
+        self.skip()  # something is on air from the start
+        self.server = await asyncio.start_server(self._client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        if self.track_seconds:
+            self._ticker = asyncio.create_task(self._tick())
+
+    async def stop(self):
+        if self._ticker:
+            self._ticker.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class FakeIceCast(object):
+    """Stand-in for icecast2's /status-json.xsl"""
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, listeners: int = 10):
+        self.host = host
+        self.port = port
+        self.listeners = listeners
+        self.requests = 0
+        self.runner: Optional[web.AppRunner] = None
+
+    async def status(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        return web.json_response({"icestats": {
+            "admin": "icemaster@localhost",
+            "host": self.host,
+            "source": {
+                "listenurl": f"http://{self.host}:{self.port}/{settings.icecast2_mount.lstrip('/')}",
+                "listeners": self.listeners,
+                "listener_peak": self.listeners,
+                "server_name": settings.liquidsoap_description,
+                "server_type": "application/ogg"
+            }
+        }})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/status-json.xsl", self.status)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+
+    async def stop(self):
+        await self.runner.cleanup()
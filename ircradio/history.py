@@ -0,0 +1,51 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import List, Optional, Tuple
+from datetime import datetime, timezone
+from html import escape
+import asyncio
+import hashlib
+
+from ircradio.models import Play
+
+# pre-rendered /history.txt: (body, etag, last modified)
+page: Optional[Tuple[bytes, str, datetime]] = None
+
+
+def render(plays: List[Play]) -> bytes:
+    if not plays:
+        return b"no history"
+
+    data = []
+    for i, p in enumerate(plays):
+        uid = escape(p.utube_id)
+        title = escape(p.song.title) if p.song else ""
+        data.append(f"{i+1}) <a target=\"_blank\" href=\"https://www.youtube.com/watch?v={uid}\">{uid}</a>; {title} <br>")
+    return "".join(data).encode()
+
+
+async def refresh(limit: int = 10):
+    global page
+    from ircradio.database import AsyncPlay
+    body = render(await AsyncPlay.history(limit=limit))
+    etag = hashlib.sha1(body).hexdigest()[:16]
+    if page and page[1] == etag:
+        return
+    # HTTP dates have second precision
+    page = (body, etag, datetime.now(timezone.utc).replace(microsecond=0))
+
+
+async def renderer():
+    """re-render once per track change"""
+    from ircradio.factory import app, now_playing
+    version = None
+    while True:
+        try:
+            if version is not None:
+                await now_playing.wait_for_change(version)
+            version = now_playing.version
+            await refresh()
+        except Exception as ex:
+            app.logger.error(f"history renderer: {ex}")
+            await asyncio.sleep(1)
@@ -0,0 +1,128 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import Dict, List, Optional
+from array import array
+from datetime import datetime
+import asyncio
+import os
+import time
+
+
+class ListenerSeries(object):
+    """Fixed size ring buffer of (unix timestamp, listeners)"""
+    def __init__(self, size: int):
+        self.size = size
+        self.timestamps = array('d', [0]) * size
+        self.values = array('i', [0]) * size
+        self.pos = 0
+        self.count = 0
+
+    def append(self, ts: float, listeners: int):
+        self.timestamps[self.pos] = ts
+        self.values[self.pos] = listeners
+        self.pos = (self.pos + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def since(self, ts: float) -> List[int]:
+        """values newer than `ts`"""
+        values = []
+        for i in range(1, self.count + 1):
+            idx = (self.pos - i) % self.size
+            if self.timestamps[idx] < ts:
+                break
+            values.append(self.values[idx])
+        return values
+
+    def summary(self, seconds: int) -> Dict:
+        values = self.since(time.time() - seconds)
+        if not values:
+            return {"peak": 0, "avg": 0, "samples": 0}
+        return {
+            "peak": max(values),
+            "avg": round(sum(values) / len(values), 2),
+            "samples": len(values)
+        }
+
+
+class IceCastStats(object):
+    """Periodically polls icecast2's status-json.xsl into a shared
+    snapshot, and keeps a listener count time series per mount."""
+    WINDOWS = {"5m": 300, "1h": 3600, "24h": 86400}
+
+    def __init__(self, interval: int = 10, downsample: int = 300):
+        self.interval = interval
+        self.downsample = downsample
+        self.sources: Dict[str, dict] = {}  # mount -> icecast source
+        self.series: Dict[str, ListenerSeries] = {}
+        self.updated: Optional[datetime] = None
+        self._last_downsample = time.time()
+
+    def fresh(self) -> bool:
+        """the snapshot is recent, i.e. icecast answered lately"""
+        return self.updated is not None and \
+            (datetime.now() - self.updated).total_seconds() < max(3 * self.interval, 15)
+
+    def listeners(self, mount: str = None) -> int:
+        if mount:
+            return self.sources.get(mount, {}).get('listeners', 0)
+        return sum(s.get('listeners', 0) for s in self.sources.values())
+
+    def summary(self) -> Dict:
+        return {
+            "updated": self.updated.isoformat() if self.updated else None,
+            "listeners": self.listeners(),
+            "mounts": {
+                mount: {
+                    "listeners": self.listeners(mount),
+                    **{name: series.summary(secs) for name, secs in self.WINDOWS.items()}
+                } for mount, series in self.series.items()
+            }
+        }
+
+    async def refresh(self):
+        from ircradio.radio import Radio
+        sources = await Radio.get_icecast_metadata()
+        if sources is None:
+            # fetch failed; keep the snapshot, it goes stale (see `fresh`)
+            return
+        if isinstance(sources, dict):
+            sources = [sources]
+
+        now = time.time()
+        self.sources = {}
+        for source in sources:
+            mount = os.path.basename(source.get('listenurl', '')) or 'unknown'
+            self.sources[mount] = source
+            if mount not in self.series:
+                self.series[mount] = ListenerSeries(size=int(86400 // self.interval))
+            self.series[mount].append(now, source.get('listeners', 0))
+        # mounts without a source (e.g. liquidsoap is down) have no listeners
+        for mount, series in self.series.items():
+            if mount not in self.sources:
+                series.append(now, 0)
+        self.updated = datetime.now()
+
+    async def store(self):
+        """downsample the last period into SQLite"""
+        from ircradio.database import write
+        from ircradio.models import ListenerStat
+        rows = []
+        for mount, series in self.series.items():
+            summary = series.summary(self.downsample)
+            if summary["samples"]:
+                rows.append({"mount": mount, "peak": summary["peak"], "avg": summary["avg"]})
+        if rows:
+            await write(lambda: ListenerStat.insert_many(rows).execute())
+
+    async def run(self):
+        from ircradio.factory import app
+        while True:
+            try:
+                await self.refresh()
+                if self.downsample and time.time() - self._last_downsample >= self.downsample:
+                    self._last_downsample = time.time()
+                    await self.store()
+            except Exception as ex:
+                app.logger.error(f"icecast stats: {ex}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,225 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import Dict, List, Optional, Set, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import asyncio
+import os
+import time
+
+import settings
+
+
+class MusicIndex(object):
+    """In-memory index of the files in the music directory, so hot
+    paths can check for existence without a stat() per filename.
+    Refreshed by a periodic scan and updated on download/delete."""
+    def __init__(self, directory: str, interval: int = 60):
+        self.directory = os.path.normpath(directory)
+        self.interval = interval
+        self.paths: Set[str] = set()
+        self.scanned: Optional[float] = None
+
+    def _scan(self) -> Set[str]:
+        with os.scandir(self.directory) as it:
+            return {os.path.join(self.directory, e.name) for e in it if e.is_file()}
+
+    async def scan(self):
+        loop = asyncio.get_event_loop()
+        self.paths = await loop.run_in_executor(None, self._scan)
+        self.scanned = time.time()
+
+    def exists(self, path: str) -> bool:
+        path = os.path.normpath(path)
+        if path in self.paths:
+            return True
+        # not seen (yet), e.g. copied in since the last scan
+        if os.path.exists(path):
+            self.paths.add(path)
+            return True
+        return False
+
+    def add(self, path: str):
+        self.paths.add(os.path.normpath(path))
+
+    def discard(self, path: str):
+        self.paths.discard(os.path.normpath(path))
+
+    async def run(self):
+        from ircradio.factory import app
+        while True:
+            try:
+                await self.scan()
+            except Exception as ex:
+                app.logger.error(f"music index: {ex}")
+            await asyncio.sleep(self.interval)
+
+
+def _extract(filepath: str) -> Tuple[str, Optional[dict]]:
+    """process pool worker; no database access in here"""
+    from ircradio.youtube import YouTube
+    try:
+        metadata = YouTube.parse_metadata(filepath)
+    except Exception:
+        return filepath, None
+    if metadata:
+        metadata = {k: v for k, v in metadata.items() if k != "data"}
+    return filepath, metadata
+
+
+def import_library(rescan: bool = False, workers: int = None, batch_size: int = 500):
+    """Add songs found in the music directory but not in the database.
+    With `rescan`, also drop database rows whose file is gone."""
+    from ircradio.models import db, Song, FileMeta
+    from ircradio.youtube import YouTube
+    from ircradio.cache import invalidate
+
+    started = time.time()
+    directory = os.path.normpath(settings.dir_music)
+    on_disk: Dict[str, Tuple[str, os.stat_result]] = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            uid, _, ext = entry.name.partition(".")
+            if ext != "ogg" or not entry.is_file() or not YouTube.is_valid_uid(uid):
+                continue
+            on_disk[uid] = (entry.path, entry.stat())
+
+    in_db = {uid for (uid,) in Song.select(Song.utube_id).tuples()}
+    missing = [uid for uid in on_disk if uid not in in_db]
+    print(f"{len(on_disk)} files on disk, {len(in_db)} songs in db, {len(missing)} to import")
+
+    # metadata: reuse FileMeta where (mtime, size) still match, parse the rest
+    metadata: Dict[str, dict] = {}
+    to_parse = []
+    cached = {m.path: m for m in FileMeta.select()}
+    for uid in missing:
+        path, stat = on_disk[uid]
+        meta = cached.get(path)
+        if meta and meta.mtime == stat.st_mtime and meta.size == stat.st_size:
+            metadata[uid] = {"name": meta.name, "duration": meta.duration}
+        else:
+            to_parse.append(path)
+
+    if to_parse:
+        db.close()  # don't share the connection with forked workers
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(to_parse) // ((workers or os.cpu_count() or 1) * 8))
+            for i, (path, meta) in enumerate(pool.map(_extract, to_parse, chunksize=chunksize)):
+                if meta:
+                    metadata[os.path.basename(path).split(".", 1)[0]] = meta
+                if (i + 1) % 1000 == 0:
+                    print(f"parsed {i + 1}/{len(to_parse)}")
+
+    songs, metas = [], []
+    for uid, meta in metadata.items():
+        path, stat = on_disk[uid]
+        songs.append({
+            "duration": meta['duration'],
+            "title": meta['name'],
+            "added_by": "radio",
+            "karma": 5,
+            "utube_id": uid
+        })
+        metas.append({
+            "path": path,
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "name": meta['name'],
+            "duration": meta['duration']
+        })
+
+    for i in range(0, len(songs), batch_size):
+        with db.atomic():
+            Song.insert_many(songs[i:i + batch_size]).on_conflict_ignore().execute()
+            FileMeta.insert_many(metas[i:i + batch_size]).on_conflict_replace().execute()
+
+    removed = 0
+    if rescan:
+        orphans = [uid for uid in in_db if uid not in on_disk]
+        for i in range(0, len(orphans), batch_size):
+            with db.atomic():
+                removed += Song.delete().where(Song.utube_id.in_(orphans[i:i + batch_size])).execute()
+        paths = {path for path, _ in on_disk.values()}
+        stale = [p for (p,) in FileMeta.select(FileMeta.path).tuples() if p not in paths]
+        for i in range(0, len(stale), batch_size):
+            FileMeta.delete().where(FileMeta.path.in_(stale[i:i + batch_size])).execute()
+
+    invalidate()
+    # bulk inserts bypass the incremental library stats
+    from ircradio.stats import reconcile
+    reconcile()
+    elapsed = time.time() - started
+    rate = len(missing) / elapsed if elapsed else 0
+    print(f"imported {len(songs)} songs ({len(to_parse)} parsed), removed {removed} orphans "
+          f"in {elapsed:.1f}s ({rate:.0f} files/s)")
+
+
+class Playlist(object):
+    """M3U playlist for LiquidSoap's autoplay source. Rewritten (atomically)
+    only when the library generation changes and the contents differ;
+    LiquidSoap is then told to reload it over telnet."""
+    def __init__(self, path: str, interval: int = 5):
+        self.path = path
+        self.interval = interval
+        self.generation = None
+        self.digest = None
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self.digest = hashlib.sha1(f.read()).hexdigest()
+
+    @staticmethod
+    def playable() -> List[Tuple[str, str, str, int]]:
+        """(utube_id, title, added_by, karma) of songs that may be autoplayed:
+        not banned and the file is present"""
+        from ircradio.factory import music_index
+        from ircradio.models import Song, Ban
+        q = Song.select(Song.utube_id, Song.title, Song.added_by, Song.karma).where(
+            (Song.banned == False) &
+            (Song.utube_id.not_in(Ban.select(Ban.utube_id_or_nick)))
+        ).order_by(Song.id).tuples()
+
+        rows = []
+        for row in q:
+            if music_index and not music_index.exists(os.path.join(settings.dir_music, f"{row[0]}.ogg")):
+                continue
+            rows.append(row)
+        return rows
+
+    @staticmethod
+    def generate() -> str:
+        lines = ["#EXTM3U"]
+        for utube_id, *_ in Playlist.playable():
+            lines.append(os.path.join(settings.dir_music, f"{utube_id}.ogg"))
+        return "\n".join(lines) + "\n"
+
+    def write(self) -> bool:
+        """returns True when the file changed"""
+        data = self.generate().encode()
+        digest = hashlib.sha1(data).hexdigest()
+        if digest == self.digest:
+            return False
+
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+        self.digest = digest
+        return True
+
+    async def run(self):
+        from ircradio import cache
+        from ircradio.factory import app
+        from ircradio.database import read
+        from ircradio.radio import Radio
+        while True:
+            try:
+                generation = cache.library_generation
+                if generation != self.generation:
+                    if await read(self.write):
+                        await Radio.command("playlist.reload")
+                        app.logger.info("playlist updated")
+                    self.generation = generation
+            except Exception as ex:
+                app.logger.error(f"playlist: {ex}")
+            await asyncio.sleep(self.interval)
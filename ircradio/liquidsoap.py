@@ -0,0 +1,132 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import List, Optional
+import asyncio
+
+
+class LiquidSoapError(Exception):
+    pass
+
+
+class LiquidSoapConnection(object):
+    """A single telnet connection to the LiquidSoap control port"""
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.sent = False  # the last send() got as far as writing
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None and \
+            not self.writer.is_closing() and \
+            not self.reader.at_eof()
+
+    async def connect(self, timeout: float):
+        self.close()
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), timeout)
+
+    def close(self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception:
+                pass
+        self.reader = None
+        self.writer = None
+
+    async def send(self, cmds: List[str]) -> List[bytes]:
+        """Write all commands at once, then read one response per
+        command. Each response is terminated by an `END` line."""
+        self.sent = True
+        self.writer.write(b"".join(cmd.encode() + b"\n" for cmd in cmds))
+        await self.writer.drain()
+        return [await self.read_response() for _ in cmds]
+
+    async def read_response(self) -> bytes:
+        data = b""
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionResetError("liquidsoap closed the connection")
+            data += line
+            if line.rstrip(b"\r\n") == b"END":
+                return data
+
+
+class LiquidSoapClient(object):
+    """Small pool of long-lived connections to the LiquidSoap
+    control port, with reconnect/backoff and per-command timeouts."""
+    def __init__(self, host: str, port: int, pool_size: int = 2,
+                 timeout: float = 5, retries: int = 3):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self._pool: Optional[asyncio.Queue] = None
+
+    def _get_pool(self) -> asyncio.Queue:
+        if self._pool is None:
+            self._pool = asyncio.Queue()
+            for _ in range(self.pool_size):
+                self._pool.put_nowait(LiquidSoapConnection(self.host, self.port))
+        return self._pool
+
+    async def _connect(self, conn: LiquidSoapConnection):
+        delay = 0.1
+        for attempt in range(self.retries):
+            try:
+                await conn.connect(timeout=self.timeout)
+                return
+            except (OSError, asyncio.TimeoutError) as ex:
+                if attempt == self.retries - 1:
+                    raise LiquidSoapError(f"could not connect to liquidsoap: {ex}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2)
+
+    async def command(self, cmd: str, timeout: float = None) -> bytes:
+        """via LiquidSoap control port"""
+        return (await self.pipeline([cmd], timeout=timeout))[0]
+
+    async def pipeline(self, cmds: List[str], timeout: float = None) -> List[bytes]:
+        """Send multiple commands over one connection in a single write"""
+        if not cmds:
+            return []
+        pool = self._get_pool()
+        conn = await pool.get()
+        try:
+            # a pooled connection may have been dropped by liquidsoap
+            # (restart, idle timeout), so retry once on a fresh one
+            for attempt in range(2):
+                if not conn.connected:
+                    await self._connect(conn)
+                conn.sent = False
+                try:
+                    return await asyncio.wait_for(conn.send(cmds), timeout or self.timeout)
+                except asyncio.TimeoutError:
+                    raise LiquidSoapError(f"liquidsoap command timed out: {cmds[0]}")
+                except (OSError, asyncio.IncompleteReadError) as ex:
+                    conn.close()
+                    # e.g. requests.push is not idempotent, only retry
+                    # when nothing was written
+                    if conn.sent or attempt == 1:
+                        raise LiquidSoapError(f"liquidsoap connection error: {ex}")
+        except BaseException:
+            # timeout, cancellation, oversized reply: unread responses
+            # would be taken as the replies to the next commands
+            conn.close()
+            raise
+        finally:
+            pool.put_nowait(conn)
+
+    async def close(self):
+        if self._pool is None:
+            return
+        while not self._pool.empty():
+            conn = self._pool.get_nowait()
+            conn.close()
+        self._pool = None
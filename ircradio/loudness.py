@@ -0,0 +1,125 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import subprocess
+import asyncio
+import time
+import re
+import os
+
+import settings
+
+# ingest (download) analysis, see start_pool()
+pool: Optional[ProcessPoolExecutor] = None
+
+
+def start_pool(workers: int) -> ProcessPoolExecutor:
+    """Workers are spawned, not forked: the web-if has threads (database
+    executors, aiohttp's resolver) and forking those can deadlock"""
+    global pool
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return pool
+
+
+def analyze(filepath: str) -> Optional[Tuple[float, float]]:
+    """EBU R128 integrated loudness (LUFS) and true peak (dBTP) via ffmpeg"""
+    try:
+        proc = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-nostats", "-nostdin", "-i", filepath,
+             "-af", "ebur128=peak=true", "-f", "null", "-"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=300)
+    except (OSError, subprocess.TimeoutExpired):
+        return
+
+    output = proc.stderr.decode(errors="ignore")
+    # the summary comes last
+    loudness = re.findall(r"I:\s+(-?[\d.]+|-inf) LUFS", output)
+    peak = re.findall(r"Peak:\s+(-?[\d.]+|-inf) dBFS", output)
+    if proc.returncode != 0 or not loudness or not peak:
+        return
+    return float(loudness[-1]), float(peak[-1])
+
+
+def gain(loudness: float, peak: float) -> float:
+    """ReplayGain track gain (dB) towards `settings.loudness_target`,
+    limited so the peak stays below -1 dBTP; LiquidSoap applies it as-is,
+    without a clipping prevention step of its own"""
+    return round(min(settings.loudness_target - loudness, -1.0 - peak), 2)
+
+
+def write_tags(filepath: str, loudness: float, peak: float):
+    import mutagen
+    f = mutagen.File(filepath)
+    f.tags['replaygain_track_gain'] = f"{gain(loudness, peak):.2f} dB"
+    f.tags['replaygain_track_peak'] = f"{10 ** (peak / 20):.6f}"
+    f.tags['replaygain_reference_loudness'] = f"{settings.loudness_target:.1f} LUFS"
+    f.save()
+
+
+def process(filepath: str) -> Tuple[str, Optional[Tuple[float, float]]]:
+    """process pool worker: measure and tag, returns (filepath, (loudness, peak))"""
+    measured = analyze(filepath)
+    if measured and measured[0] != float("-inf"):
+        try:
+            write_tags(filepath, *measured)
+        except Exception:
+            return filepath, None
+        return filepath, measured
+    return filepath, None
+
+
+async def measure(utube_id: str) -> Optional[Tuple[float, float]]:
+    """measure (and tag) a freshly downloaded song"""
+    from ircradio.database import write
+    from ircradio.models import Song
+    loop = asyncio.get_event_loop()
+    filepath = os.path.join(settings.dir_music, f"{utube_id}.ogg")
+    _, measured = await loop.run_in_executor(start_pool(settings.loudness_workers), process, filepath)
+    if measured:
+        await write(lambda: Song.update(loudness=measured[0], peak=measured[1]).where(
+            Song.utube_id == utube_id).execute())
+    return measured
+
+
+def backfill(workers: int = None, batch_size: int = 100):
+    """Measure songs that have no loudness yet, across `workers` processes"""
+    from ircradio.models import db, Song
+
+    started = time.time()
+    uids = [uid for (uid,) in Song.select(Song.utube_id).where(Song.loudness.is_null()).tuples()]
+    paths = [os.path.join(settings.dir_music, f"{uid}.ogg") for uid in uids]
+    paths = [p for p in paths if os.path.exists(p)]
+    print(f"{len(uids)} songs without loudness, {len(paths)} files to analyze")
+    if not paths:
+        return
+
+    db.close()  # don't share the connection with forked workers
+    done, failed = 0, 0
+    batch: List[Tuple[str, float, float]] = []
+
+    def flush():
+        with db.atomic():
+            for uid, loudness, peak in batch:
+                Song.update(loudness=loudness, peak=peak).where(Song.utube_id == uid).execute()
+        batch.clear()
+
+    with ProcessPoolExecutor(max_workers=workers) as _pool:
+        for filepath, measured in _pool.map(process, paths):
+            if not measured:
+                failed += 1
+                continue
+            batch.append((os.path.basename(filepath).split(".", 1)[0], *measured))
+            done += 1
+            if len(batch) >= batch_size:
+                flush()
+                print(f"analyzed {done + failed}/{len(paths)}")
+    if batch:
+        flush()
+
+    elapsed = time.time() - started
+    print(f"measured {done} songs, {failed} failed, in {elapsed:.1f}s "
+          f"({len(paths) / elapsed if elapsed else 0:.1f} files/s)")
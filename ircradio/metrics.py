@@ -0,0 +1,143 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import Callable, Dict, List, Tuple
+from bisect import bisect_left
+import time
+
+# all metrics, in registration order; rendered by /metrics
+registry: List['Metric'] = []
+
+# seconds; telnet round trips and cheap queries sit at the low end,
+# downloads at the high end
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _labels(names: Tuple[str, ...], values: Tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric(object):
+    type = "untyped"
+
+    def __init__(self, name: str, doc: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        registry.append(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, doc: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, doc, labelnames)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in self.values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, doc: str, labelnames: Tuple[str, ...] = (), buckets: Tuple = BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self.values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        item = self.values.get(labels)
+        if item is None:
+            item = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        item[0][bisect_left(self.buckets, value)] += 1
+        item[1] += value
+        item[2] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        names = self.labelnames + ("le",)
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Callback(Metric):
+    """Value read from the application at scrape time; costs nothing
+    in between"""
+    def __init__(self, name: str, doc: str, func: Callable[[], float], type: str = "gauge"):
+        super().__init__(name, doc)
+        self.func = func
+        self.type = type
+
+    def samples(self) -> List[str]:
+        try:
+            return [f"{self.name} {self.func()}"]
+        except Exception:
+            return []
+
+
+class Timer(object):
+    """`with timed(histogram, *labels):` observes the elapsed seconds,
+    and counts an error when the block raises and `errors` is given"""
+    __slots__ = ("histogram", "labels", "errors", "started")
+
+    def __init__(self, histogram: Histogram, labels: Tuple, errors: Counter = None):
+        self.histogram = histogram
+        self.labels = labels
+        self.errors = errors
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        if exc_type is not None and self.errors is not None:
+            self.errors.inc(*self.labels)
+
+
+def timed(histogram: Histogram, *labels, errors: Counter = None) -> Timer:
+    return Timer(histogram, labels, errors)
+
+
+def render() -> str:
+    return "\n".join(m.render() for m in registry) + "\n"
+
+
+liquidsoap_seconds = Histogram(
+    "ircradio_liquidsoap_command_seconds", "LiquidSoap telnet round trips", ("command",))
+liquidsoap_errors = Counter(
+    "ircradio_liquidsoap_command_errors_total", "Failed LiquidSoap telnet round trips", ("command",))
+db_seconds = Histogram(
+    "ircradio_db_seconds", "SQLite calls, including the wait for a pool thread", ("pool", "query"))
+download_seconds = Histogram(
+    "ircradio_ytdlp_seconds", "yt-dlp run time per download")
+downloads = Counter(
+    "ircradio_downloads_total", "Finished downloads", ("status",))
+command_seconds = Histogram(
+    "ircradio_discord_command_seconds", "Discord command handling time", ("command",))
+command_errors = Counter(
+    "ircradio_discord_command_errors_total", "Discord commands that raised", ("command",))
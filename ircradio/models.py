@@ -3,17 +3,33 @@
 
 import os
 import re
-from typing import Optional, List
+import json
+import base64
+from typing import Optional, List, Tuple
 from datetime import datetime
 
-import mutagen
 from peewee import SqliteDatabase, SQL
 import peewee as pw
 
 from ircradio.youtube import YouTube
+from ircradio.cache import invalidate
 import settings
 
-db = SqliteDatabase(f"{settings.cwd}/data/db.sqlite3")
+PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -1024 * 32,  # 32MB
+    'mmap_size': 1024 * 1024 * 256,
+    'temp_store': 'memory'
+}
+db = SqliteDatabase(f"{settings.cwd}/data/db.sqlite3", pragmas=PRAGMAS)
+
+# set by Song.setup_fts(), LIKE queries are used when unavailable
+fts5_enabled = False
+
+# titles are "artist - title"
+FTS_ARTIST = "CASE WHEN instr({row}.title, ' - ') > 0 " \
+             "THEN substr({row}.title, 1, instr({row}.title, ' - ') - 1) ELSE '' END"
 
 
 class Ban(pw.Model):
@@ -23,6 +39,103 @@ class Ban(pw.Model):
     class Meta:
         database = db
 
+class Download(pw.Model):
+    """Pending download jobs, restored on restart"""
+    id = pw.AutoField()
+    date_added = pw.DateTimeField(default=datetime.now)
+    utube_id = pw.CharField(unique=True)
+    added_by = pw.CharField()
+    channel_id = pw.BigIntegerField(null=True)
+
+    class Meta:
+        database = db
+
+class ListenerStat(pw.Model):
+    """Listener counts per mount, downsampled by IceCastStats"""
+    id = pw.AutoField()
+    date = pw.DateTimeField(default=datetime.now, index=True)
+    mount = pw.CharField()
+    peak = pw.IntegerField()
+    avg = pw.FloatField()
+
+    class Meta:
+        database = db
+
+class LibraryStat(pw.Model):
+    """Per submitter totals, updated on song create/delete and
+    reconciled in the background (see ircradio.stats)"""
+    added_by = pw.CharField(primary_key=True, constraints=[SQL('COLLATE NOCASE')])
+    songs = pw.IntegerField(default=0)
+    duration = pw.IntegerField(default=0)  # seconds
+    bytes = pw.BigIntegerField(default=0)
+
+    @staticmethod
+    def apply(added_by: str, songs: int, duration: int, size: int):
+        LibraryStat.insert(added_by=added_by, songs=songs, duration=duration, bytes=size).on_conflict(
+            conflict_target=[LibraryStat.added_by],
+            update={
+                LibraryStat.songs: LibraryStat.songs + songs,
+                LibraryStat.duration: LibraryStat.duration + duration,
+                LibraryStat.bytes: LibraryStat.bytes + size
+            }).execute()
+
+    @staticmethod
+    def totals() -> dict:
+        songs, duration, size = LibraryStat.select(
+            pw.fn.SUM(LibraryStat.songs), pw.fn.SUM(LibraryStat.duration), pw.fn.SUM(LibraryStat.bytes)
+        ).tuples().first() or (0, 0, 0)
+        submitters = LibraryStat.select(LibraryStat.added_by, LibraryStat.songs).where(
+            LibraryStat.songs > 0).order_by(LibraryStat.songs.desc()).tuples()
+        return {
+            "songs": songs or 0,
+            "duration": duration or 0,
+            "bytes": size or 0,
+            "submitters": dict(submitters)
+        }
+
+    class Meta:
+        database = db
+
+class FileMeta(pw.Model):
+    """Parsed metadata of files in the music directory"""
+    path = pw.CharField(primary_key=True)
+    mtime = pw.FloatField()
+    size = pw.IntegerField()
+    name = pw.CharField()
+    duration = pw.FloatField()
+
+    @staticmethod
+    def lookup(path: str, mtime: float, size: int) -> Optional[dict]:
+        try:
+            meta = FileMeta.get_by_id(path)
+        except FileMeta.DoesNotExist:
+            return
+        if meta.mtime != mtime or meta.size != size:
+            return
+        return {
+            "name": meta.name,
+            "data": None,
+            "duration": meta.duration,
+            "path": path
+        }
+
+    @staticmethod
+    def store(path: str, mtime: float, size: int, metadata: dict):
+        FileMeta.replace(
+            path=path, mtime=mtime, size=size,
+            name=metadata['name'], duration=metadata['duration']
+        ).execute()
+
+    class Meta:
+        database = db
+
+def _filesize(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
 class Song(pw.Model):
     id = pw.AutoField()
     date_added = pw.DateTimeField(default=datetime.now)
@@ -33,14 +146,43 @@ class Song(pw.Model):
     duration = pw.IntegerField()
     karma = pw.IntegerField(default=5, index=True)
     banned = pw.BooleanField(default=False)
+    plays = pw.IntegerField(default=0, index=True)
+    loudness = pw.FloatField(null=True)  # EBU R128 integrated, LUFS
+    peak = pw.FloatField(null=True)  # true peak, dBTP
+
+    @classmethod
+    def create(cls, **kwargs) -> 'Song':
+        with db.atomic():
+            song = super().create(**kwargs)
+            LibraryStat.apply(song.added_by, 1, int(song.duration or 0), _filesize(song.filepath))
+        # save() invalidated before the commit
+        invalidate()
+        return song
+
+    @staticmethod
+    def delete_by_uid(utube_id: str) -> int:
+        """delete the row (not the file), keeping LibraryStat in sync"""
+        with db.atomic():
+            song = Song.by_uid(utube_id)
+            if not song:
+                return 0
+            deleted = Song.delete().where(Song.id == song.id).execute()
+            if deleted:
+                LibraryStat.apply(song.added_by, -1, -int(song.duration or 0), -_filesize(song.filepath))
+        invalidate()
+        return deleted
 
     @staticmethod
     def delete_song(utube_id: str) -> bool:
         from ircradio.factory import app
         try:
+            from ircradio.factory import music_index
             fn = f"{settings.dir_music}/{utube_id}.ogg"
-            Song.delete().where(Song.utube_id == utube_id).execute()
+            Song.delete_by_uid(utube_id)
             os.remove(fn)
+            FileMeta.delete().where(FileMeta.path == fn).execute()
+            if music_index:
+                music_index.discard(fn)
         except Exception as ex:
             app.logger.error(f"{ex}")
             return False
@@ -58,6 +200,13 @@ class Song(pw.Model):
             except:
                 pass
 
+        try:
+            songs = Song.search_fts(needle, columns=["title", "artist"])
+            if songs is not None:
+                return songs
+        except:
+            pass
+
         try:
             q = Song.select().filter(Song.title ** f"%{needle}%")
             return [s for s in q]
@@ -66,6 +215,92 @@ class Song(pw.Model):
 
         return []
 
+    @staticmethod
+    def search_fts(needle: str, columns: List[str], limit: int = -1, offset: int = 0) -> Optional[List['Song']]:
+        """Token prefix search ranked by bm25, None when FTS5 is unavailable"""
+        if not fts5_enabled:
+            return
+        tokens = re.findall(r"\w+", needle)
+        if not tokens:
+            return []
+
+        terms = " ".join(f'"{t}"*' for t in tokens)
+        match = f"{{{' '.join(columns)}}} : ({terms})"
+        cursor = db.execute_sql(
+            "SELECT rowid FROM song_fts WHERE song_fts MATCH ? "
+            "ORDER BY bm25(song_fts, 10.0, 5.0, 1.0) LIMIT ? OFFSET ?",
+            (match, limit, offset))
+        ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return []
+
+        songs = {s.id: s for s in Song.select().where(Song.id.in_(ids))}
+        return [songs[_id] for _id in ids if _id in songs]
+
+    @staticmethod
+    def setup_fts() -> bool:
+        """Create the song_fts index + sync triggers, backfill when needed"""
+        global fts5_enabled
+        from ircradio.factory import app
+        artist_new = FTS_ARTIST.format(row="new")
+        try:
+            db.execute_sql(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS song_fts USING fts5("
+                "title, artist, added_by, tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+        except Exception as ex:
+            app.logger.warning(f"FTS5 not available, search falls back to LIKE: {ex}")
+            fts5_enabled = False
+            return False
+
+        with db.atomic():
+            db.execute_sql(
+                "CREATE TRIGGER IF NOT EXISTS song_fts_ai AFTER INSERT ON song BEGIN "
+                "INSERT INTO song_fts(rowid, title, artist, added_by) "
+                f"VALUES (new.id, new.title, {artist_new}, new.added_by); END")
+            db.execute_sql(
+                "CREATE TRIGGER IF NOT EXISTS song_fts_ad AFTER DELETE ON song BEGIN "
+                "DELETE FROM song_fts WHERE rowid = old.id; END")
+            db.execute_sql(
+                "CREATE TRIGGER IF NOT EXISTS song_fts_au AFTER UPDATE OF title, added_by ON song BEGIN "
+                "DELETE FROM song_fts WHERE rowid = old.id; "
+                "INSERT INTO song_fts(rowid, title, artist, added_by) "
+                f"VALUES (new.id, new.title, {artist_new}, new.added_by); END")
+
+            count_fts = db.execute_sql("SELECT count(*) FROM song_fts").fetchone()[0]
+            count_songs = db.execute_sql("SELECT count(*) FROM song").fetchone()[0]
+            if count_fts != count_songs:
+                app.logger.info(f"backfilling song_fts with {count_songs} songs")
+                db.execute_sql("DELETE FROM song_fts")
+                db.execute_sql(
+                    "INSERT INTO song_fts(rowid, title, artist, added_by) "
+                    f"SELECT id, title, {FTS_ARTIST.format(row='song')}, added_by FROM song")
+
+        fts5_enabled = True
+        return True
+
+    @staticmethod
+    def library(added_by: str, order: str = "date", cursor: str = None,
+                limit: int = 100) -> Tuple[List['Song'], Optional[str]]:
+        """Keyset paginated songs of a submitter, newest (order=date) or
+        best (order=karma) first. Returns the page and the next cursor."""
+        field = Song.karma if order == "karma" else Song.date_added
+        q = Song.select().where(Song.added_by == added_by)
+        if cursor:
+            value, _id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if field is Song.date_added:
+                value = datetime.fromisoformat(value)
+            q = q.where((field < value) | ((field == value) & (Song.id < _id)))
+
+        songs = list(q.order_by(field.desc(), Song.id.desc()).limit(limit + 1))
+        if len(songs) <= limit:
+            return songs, None
+
+        songs = songs[:limit]
+        last = songs[-1]
+        value = last.karma if field is Song.karma else last.date_added.isoformat()
+        cursor = base64.urlsafe_b64encode(json.dumps([value, last.id]).encode()).decode()
+        return songs, cursor
+
     @staticmethod
     def by_uid(uid: str) -> Optional['Song']:
         try:
@@ -84,6 +319,33 @@ class Song(pw.Model):
         except:
             return Song.auto_create_from_filepath(filepath)
 
+    @staticmethod
+    def from_filepaths(filepaths: List[str]) -> List['Song']:
+        """Resolve many filepaths with a single query, keeping order"""
+        from ircradio.factory import app
+        uids = {}
+        for filepath in filepaths:
+            name = os.path.basename(filepath).split(".", 1)[0]
+            if YouTube.is_valid_uid(name):
+                uids[filepath] = name
+
+        found = {}
+        if uids:
+            q = Song.select().where(Song.utube_id.in_(list(set(uids.values()))))
+            found = {s.utube_id: s for s in q}
+
+        songs = []
+        for filepath, uid in uids.items():
+            song = found.get(uid)
+            if not song:
+                try:
+                    song = Song.auto_create_from_filepath(filepath)
+                except Exception as ex:
+                    app.logger.warning(f"skipping {filepath}; file not found or something: {ex}")
+            if song:
+                songs.append(song)
+        return songs
+
     @staticmethod
     def auto_create_from_filepath(filepath: str) -> Optional['Song']:
         from ircradio.factory import app
@@ -110,6 +372,37 @@ class Song(pw.Model):
             app.logger.error(f"{ex}")
             pass
 
+    def save(self, *args, **kwargs):
+        # after the write, or a search racing it caches old rows as current
+        result = super().save(*args, **kwargs)
+        invalidate()
+        return result
+
+    @staticmethod
+    def vote(utube_id: str, nick: str, play_id: Optional[int], played_at: datetime, delta: int) -> Optional[int]:
+        """Record a vote and apply it to the karma (clamped to 0-10) in
+        one transaction. Returns the new karma, or None when `nick`
+        already voted on this play. Raises Song.DoesNotExist (and rolls
+        back the vote) when the song is gone."""
+        with db.atomic():
+            try:
+                Vote.insert(utube_id=utube_id, nick=nick, play_id=play_id,
+                            played_at=played_at, delta=delta).execute()
+            except pw.IntegrityError:
+                return None
+
+            # no UPDATE .. RETURNING, that needs SQLite >= 3.35
+            karma = pw.fn.MIN(10, pw.fn.MAX(0, Song.karma + delta))
+            if not Song.update(karma=karma).where(Song.utube_id == utube_id).execute():
+                raise Song.DoesNotExist(f"song {utube_id} not found")
+            karma = Song.select(Song.karma).where(Song.utube_id == utube_id).scalar()
+        invalidate()
+        return karma
+
+    @staticmethod
+    def most_played(limit: int = 25) -> List['Song']:
+        return list(Song.select().where(Song.plays > 0).order_by(Song.plays.desc()).limit(limit))
+
     @property
     def filepath(self):
         """Absolute"""
@@ -125,3 +418,89 @@ class Song(pw.Model):
 
     class Meta:
         database = db
+        indexes = (
+            # keyset pagination for Song.library()
+            (('added_by', 'date_added'), False),
+            (('added_by', 'karma'), False),
+        )
+
+class Vote(pw.Model):
+    """One vote per nick per play of a song; Song.karma is the
+    (clamped) running total"""
+    id = pw.AutoField()
+    date_added = pw.DateTimeField(default=datetime.now)
+    utube_id = pw.CharField(index=True)
+    nick = pw.CharField()
+    play_id = pw.IntegerField(null=True)  # Play.id, survives web-if restarts
+    played_at = pw.DateTimeField()  # as first seen by this web-if
+    delta = pw.SmallIntegerField()
+
+    class Meta:
+        database = db
+        indexes = (
+            (('nick', 'play_id'), True),
+            # when the play could not be recorded
+            (('nick', 'utube_id', 'played_at'), True),
+        )
+
+class Play(pw.Model):
+    """Track starts, recorded by the now playing tracker"""
+    id = pw.AutoField()
+    utube_id = pw.CharField()
+    added_by = pw.CharField()
+    started_at = pw.DateTimeField(default=datetime.now, index=True)
+    listeners = pw.IntegerField(null=True)
+
+    @staticmethod
+    def record(song: Song, started_at: datetime, listeners: int = None) -> Optional['Play']:
+        """Also bumps Song.plays. A restart of the web-if sees the same
+        track start again, that one is not counted twice; the existing
+        row is returned instead."""
+        last = Play.select().order_by(Play.id.desc()).first()
+        if last and last.utube_id == song.utube_id and \
+                (started_at - last.started_at).total_seconds() < (song.duration or 0):
+            return last
+
+        with db.atomic():
+            play = Play.create(utube_id=song.utube_id, added_by=song.added_by,
+                               started_at=started_at, listeners=listeners)
+            Song.update(plays=Song.plays + 1).where(Song.id == song.id).execute()
+        return play
+
+    @staticmethod
+    def history(before: int = None, limit: int = 50) -> List['Play']:
+        """newest first, keyset paginated on id; `.song` is None for
+        songs that have since been deleted"""
+        q = Play.select(Play, Song).join(
+            Song, pw.JOIN.LEFT_OUTER, on=(Play.utube_id == Song.utube_id), attr="song")
+        if before:
+            q = q.where(Play.id < before)
+        return list(q.order_by(Play.id.desc()).limit(limit))
+
+    @staticmethod
+    def count_by(added_by: str) -> int:
+        """plays of songs submitted by `added_by`"""
+        return Play.select().where(Play.added_by == added_by).count()
+
+    class Meta:
+        database = db
+        indexes = (
+            (('utube_id', 'started_at'), False),
+            (('added_by', 'started_at'), False),
+        )
+
+
+def migrate():
+    """Add columns that were introduced after a table was created"""
+    from playhouse.migrate import SqliteMigrator, migrate as _migrate
+    migrator = SqliteMigrator(db)
+    for model in pw.Model.__subclasses__():
+        table = model._meta.table_name
+        if not db.table_exists(table):
+            continue
+        existing = {c.name for c in db.get_columns(table)}
+        ops = [migrator.add_column(table, f.column_name, f)
+               for f in model._meta.sorted_fields if f.column_name not in existing]
+        if ops:
+            _migrate(*ops)
+
@@ -0,0 +1,86 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import List, Optional
+from datetime import datetime
+import asyncio
+
+from ircradio.models import Song
+
+
+class NowPlaying(object):
+    """Current track and recent history, kept up to date by a single
+    background poll of LiquidSoap. Consumers read the snapshot or await
+    `wait_for_change()` instead of querying LiquidSoap themselves."""
+    def __init__(self, interval: float = 5):
+        self.interval = interval
+        self.history: List[Song] = []
+        self.version: int = 0
+        self.updated: Optional[datetime] = None
+        self.started: Optional[datetime] = None  # current track, as first seen
+        self.play_id: Optional[int] = None  # current track's Play row
+        self._changed = asyncio.Condition()
+        self._poke = asyncio.Event()
+
+    @property
+    def song(self) -> Optional[Song]:
+        """0 = currently playing"""
+        if self.history:
+            return self.history[0]
+
+    async def refresh(self) -> bool:
+        """poll LiquidSoap once, returns True when the history changed"""
+        from ircradio.radio import Radio
+        history = await Radio.history()
+        self.updated = datetime.now()
+
+        if [s.utube_id for s in history] == [s.utube_id for s in self.history]:
+            return False
+
+        if not self.history or not history or history[0].utube_id != self.history[0].utube_id:
+            self.started = self.updated
+            self.play_id = None
+            if history:
+                # before notifying, consumers may read the play history
+                await self.record(history[0])
+
+        async with self._changed:
+            self.history = history
+            self.version += 1
+            self._changed.notify_all()
+        return True
+
+    async def record(self, song: Song):
+        from ircradio.factory import app, icecast_stats
+        from ircradio.database import AsyncPlay
+        listeners = icecast_stats.listeners() if icecast_stats and icecast_stats.fresh() else None
+        try:
+            play = await AsyncPlay.record(song, self.started, listeners)
+            self.play_id = play.id if play else None
+        except Exception as ex:
+            app.logger.error(f"recording play: {ex}")
+
+    async def wait_for_change(self, version: int, timeout: float = None) -> int:
+        """wait until the snapshot is newer than `version`"""
+        async with self._changed:
+            await asyncio.wait_for(
+                self._changed.wait_for(lambda: self.version != version), timeout)
+            return self.version
+
+    def poke(self):
+        """refresh early, e.g. after a skip"""
+        self._poke.set()
+
+    async def run(self):
+        from ircradio.factory import app
+        while True:
+            try:
+                await self.refresh()
+            except Exception as ex:
+                app.logger.error(f"now playing: {ex}")
+
+            try:
+                await asyncio.wait_for(self._poke.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._poke.clear()
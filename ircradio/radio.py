@@ -3,41 +3,55 @@
 
 import re
 import os
-import socket
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Union
 import asyncio
 import sys
 
 import settings
 from ircradio.models import Song
+from ircradio.database import AsyncSong
 from ircradio.utils import httpget
+from ircradio import metrics
+from ircradio.metrics import timed
 from ircradio.youtube import YouTube
 
 
 class Radio:
     @staticmethod
-    def queue(song: Song) -> bool:
-        from ircradio.factory import app
-        queues = Radio.queues()
-        queues_filepaths = [s.filepath for s in queues]
+    async def queue(song: Song) -> bool:
+        from ircradio.factory import app, bans
+        if song.utube_id in bans:
+            app.logger.info(f"not queueing banned song: {song.utube_id}")
+            return False
+
+        queues_filepaths = await Radio.queue_filepaths()
+
+        # the head of the request queue may be the song currently playing
+        if queues_filepaths and queues_filepaths[0] == song.filepath:
+            now_playing = await Radio.now_playing()
+            if now_playing and now_playing.filepath == song.filepath:
+                queues_filepaths = queues_filepaths[1:]
 
         if song.filepath in queues_filepaths:
             app.logger.info(f"already added to queue: {song.filepath}")
             return False
 
-        Radio.command(f"requests.push {song.filepath}")
+        await Radio.command(f"requests.push {song.filepath}")
         return True
 
     @staticmethod
-    def skip() -> None:
-        Radio.command(f"{settings.liquidsoap_iface}.skip")
+    async def skip() -> None:
+        from ircradio.factory import now_playing
+        await Radio.command(f"{settings.liquidsoap_iface}.skip")
+        if now_playing:
+            now_playing.poke()
 
     @staticmethod
-    def queues() -> Optional[List[Song]]:
-        """get queued songs"""
+    async def queue_filepaths() -> List[str]:
+        """get filepaths of queued requests, in order"""
         from ircradio.factory import app
 
-        queues = Radio.command(f"requests.queue")
+        queues = await Radio.command(f"requests.queue")
         try:
             queues = [q for q in queues.split(b"\r\n") if q != b"END" and q]
             if not queues:
@@ -47,51 +61,55 @@ class Radio:
             app.logger.error(str(ex))
             raise Exception("Error")
 
+        # all metadata lookups in one round trip
+        metas = await Radio.pipeline([f"request.metadata {request_id}" for request_id in queues])
+
         paths = []
-        for request_id in queues:
-            meta = Radio.command(f"request.metadata {request_id}")
+        for meta in metas:
             path = Radio.filenames_from_strlist(meta.decode(errors="ignore").split("\n"))
             if path:
                 paths.append(path[0])
+        return list(dict.fromkeys(paths))
 
-        songs = []
-        for fn in list(dict.fromkeys(paths)):
-            try:
-                song = Song.from_filepath(fn)
-                if not song:
-                    continue
-                songs.append(song)
-            except Exception as ex:
-                app.logger.warning(f"skipping {fn}; file not found or something: {ex}")
+    @staticmethod
+    async def queues(now_playing: Optional[Song] = None) -> Optional[List[Song]]:
+        """get queued songs"""
+        paths = await Radio.queue_filepaths()
+        if not paths:
+            return []
+
+        songs = await AsyncSong.from_filepaths(paths)
 
         # remove the now playing song from the queue
-        now_playing = Radio.now_playing()
+        if now_playing is None:
+            now_playing = await Radio.now_playing()
         if songs and now_playing:
             if songs[0].filepath == now_playing.filepath:
                 songs = songs[1:]
         return songs
 
     @staticmethod
-    async def get_icecast_metadata() -> Optional[Dict]:
+    async def get_icecast_metadata() -> Optional[Union[Dict, List[Dict]]]:
+        """icecast2 source(s), [] when there is no source, None on error"""
         from ircradio.factory import app
         # http://127.0.0.1:24100/status-json.xsl
         url = f"http://{settings.icecast2_bind_host}:{settings.icecast2_bind_port}"
         url = f"{url}/status-json.xsl"
         try:
-            blob = await httpget(url, json=True)
+            blob = await httpget(url, json=True, cache_ttl=settings.icecast2_stats_cache)
             if not isinstance(blob, dict) or "icestats" not in blob:
                 raise Exception("icecast2 metadata not dict")
-            return blob["icestats"].get('source')
+            return blob["icestats"].get('source', [])
         except Exception as ex:
             app.logger.error(f"{ex}")
 
     @staticmethod
-    def history() -> Optional[List[Song]]:
+    async def history() -> Optional[List[Song]]:
         # 0 = currently playing
         from ircradio.factory import app
 
         try:
-            status = Radio.command(f"{settings.liquidsoap_iface}.metadata")
+            status = await Radio.command(f"{settings.liquidsoap_iface}.metadata")
             status = status.decode(errors="ignore")
         except Exception as ex:
             app.logger.error(f"{ex}")
@@ -103,15 +121,7 @@ class Radio:
             # reverse, limit
             paths = paths[::-1][:5]
 
-            songs = []
-            for fn in list(dict.fromkeys(paths)):
-                try:
-                    song = Song.from_filepath(fn)
-                    if not song:
-                        continue
-                    songs.append(song)
-                except Exception as ex:
-                    app.logger.warning(f"skipping {fn}; file not found or something: {ex}")
+            songs = await AsyncSong.from_filepaths(list(dict.fromkeys(paths)))
         except Exception as ex:
             app.logger.error(f"{ex}")
             app.logger.error(f"liquidsoap status:\n{status}")
@@ -119,29 +129,39 @@ class Radio:
         return songs
 
     @staticmethod
-    def command(cmd: str) -> bytes:
+    async def command(cmd: str) -> bytes:
         """via LiquidSoap control port"""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((settings.liquidsoap_host, settings.liquidsoap_port))
-        sock.sendall(cmd.encode() + b"\n")
-        data = sock.recv(4096*1000)
-        sock.close()
-        return data
+        from ircradio.factory import liquidsoap
+        with timed(metrics.liquidsoap_seconds, cmd.split(" ", 1)[0], errors=metrics.liquidsoap_errors):
+            return await liquidsoap.command(cmd)
+
+    @staticmethod
+    async def pipeline(cmds: List[str]) -> List[bytes]:
+        """multiple commands in one round trip"""
+        from ircradio.factory import liquidsoap
+        if not cmds:
+            return []
+        with timed(metrics.liquidsoap_seconds, cmds[0].split(" ", 1)[0], errors=metrics.liquidsoap_errors):
+            return await liquidsoap.pipeline(cmds)
 
     @staticmethod
-    def liquidsoap_reachable():
+    async def liquidsoap_reachable():
         from ircradio.factory import app
         try:
-            Radio.command("help")
+            await Radio.command("help")
         except Exception as ex:
             app.logger.error("liquidsoap not reachable")
             return False
         return True
 
     @staticmethod
-    def now_playing():
+    async def now_playing():
+        from ircradio import factory
+        if factory.now_playing and factory.now_playing.version:
+            return factory.now_playing.song
+
         try:
-            now_playing = Radio.history()
+            now_playing = await Radio.history()
             if now_playing:
                 return now_playing[0]
         except:
@@ -149,20 +169,30 @@ class Radio:
 
     @staticmethod
     async def listeners():
-        data: dict = await Radio.get_icecast_metadata()
+        from ircradio.factory import icecast_stats
+        if icecast_stats and icecast_stats.fresh():
+            return icecast_stats.listeners()
+
+        data = await Radio.get_icecast_metadata()
         if not data:
             return 0
+        if isinstance(data, list):
+            return sum(s.get('listeners', 0) for s in data)
         return data.get('listeners', 0)
 
     @staticmethod
     def filenames_from_strlist(strlist: List[str]) -> List[str]:
+        from ircradio.factory import music_index
         paths = []
         for line in strlist:
             if not line.startswith("filename"):
                 continue
             line = line[10:]
             fn = line[:-1]
-            if not os.path.exists(fn):
+            if music_index:
+                if not music_index.exists(fn):
+                    continue
+            elif not os.path.exists(fn):
                 continue
             paths.append(fn)
         return paths
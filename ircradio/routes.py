@@ -2,43 +2,120 @@
 # Copyright (c) 2021, dsc@xmr.pm
 
 from datetime import datetime
-from typing import Tuple, Optional
-from quart import request, render_template, abort, jsonify
+from typing import Tuple, Optional, List
+from quart import request, websocket, render_template, stream_template, abort, jsonify, Response
 import asyncio
 import json
+import time
 
 import settings
 from ircradio.factory import app
-from ircradio.radio import Radio
+from ircradio import cache
+from ircradio.cache import ResponseCache
+from ircradio import metrics
+from ircradio.database import AsyncSong, AsyncPlay, read
 
 
 @app.route("/")
 async def root():
-    return await render_template("index.html", settings=settings)
+    from ircradio.factory import icecast_stats
+    listeners = icecast_stats.listeners() if icecast_stats and icecast_stats.fresh() else 0
+    return await render_template("index.html", settings=settings, listeners=listeners)
 
 
-history_cache: Optional[Tuple] = None
+@app.route("/stats.json")
+async def stats_library():
+    from ircradio.stats import summary
+    return jsonify(await summary())
 
 
-@app.route("/history.txt")
-async def history():
-    global history_cache
-    now = datetime.now()
-    if history_cache:
-        if (now - history_cache[0]).total_seconds() <= 5:
-            print("from cache")
-            return history_cache[1]
+@app.route("/stats/listeners.json")
+async def stats_listeners():
+    from ircradio.factory import icecast_stats
+    if not icecast_stats:
+        abort(404)
+    return jsonify(icecast_stats.summary())
+
+
+search_cache = ResponseCache()
+metrics.Callback("ircradio_search_cache_hits_total", "/search response cache hits",
+                 lambda: search_cache.hits, type="counter")
+metrics.Callback("ircradio_search_cache_misses_total", "/search response cache misses",
+                 lambda: search_cache.misses, type="counter")
+
+
+@app.route("/metrics")
+async def metrics_route():
+    # Prometheus text format
+    if not settings.enable_metrics_route:
+        abort(404)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+# served while the rest of startup is still running
+STARTUP_ROUTES = ("/healthz", "/readyz", "/metrics")
+
+
+@app.before_request
+async def startup_gate():
+    from ircradio.factory import subsystems
+    if subsystems.get("database") != "up" and request.path not in STARTUP_ROUTES:
+        return Response("starting up", status=503, headers={"Retry-After": "1"}, mimetype="text/plain")
+
+
+def _fresh(updated: Optional[datetime], interval: float) -> bool:
+    return updated is not None and (datetime.now() - updated).total_seconds() < max(3 * interval, 15)
+
+
+@app.route("/healthz")
+async def healthz():
+    """liveness: the event loop answers"""
+    from ircradio.factory import started
+    return jsonify({"status": "ok", "uptime": round(time.time() - started, 3)})
+
 
-    history = Radio.history()
-    if not history:
-        return "no history"
+@app.route("/readyz")
+async def readyz():
+    """readiness: 200 once every startup phase is up and LiquidSoap
+    answers; Discord and icecast are reported, but don't gate"""
+    from ircradio import factory
+    phases = dict(factory.subsystems)
+    ready = bool(phases) and all(status == "up" for name, status in phases.items() if name != "discord")
 
-    data = ""
-    for i, s in enumerate(history[:10]):
-        data += f"{i+1}) <a target=\"_blank\" href=\"https://www.youtube.com/watch?v={s.utube_id}\">{s.utube_id}</a>; {s.title} <br>"
+    np, stats, bot = factory.now_playing, factory.icecast_stats, factory.discord_bot
+    liquidsoap = "up" if np and _fresh(np.updated, np.interval) else "down"
+    icecast = "up" if stats and stats.fresh() else "down"
+    discord = "up" if bot and bot.is_ready() else "down"
+    ready = ready and liquidsoap == "up"
 
-    history_cache = [now, data]
-    return data
+    return jsonify({
+        "ready": ready,
+        "uptime": round(time.time() - factory.started, 3),
+        "subsystems": phases,
+        "liquidsoap": liquidsoap,
+        "icecast": icecast,
+        "discord": discord
+    }), 200 if ready else 503
+
+
+@app.route("/history.txt")
+async def history():
+    # pre-rendered on track change by ircradio.history.renderer
+    from ircradio import history as _history
+    if _history.page is None:
+        await _history.refresh()
+
+    body, etag, last_modified = _history.page
+    if request.if_none_match.contains(etag) or \
+            (not request.if_none_match and request.if_modified_since and
+             request.if_modified_since >= last_modified):
+        response = Response(b"", status=304)
+    else:
+        response = Response(body, mimetype="text/html")
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 
 @app.route("/search")
@@ -48,7 +125,6 @@ async def search():
     if not settings.enable_search_route:
         abort(404)
 
-    from ircradio.models import Song
     name = request.args.get("name")
     limit = request.args.get("limit", '20')
     offset = request.args.get("offset", '0')
@@ -66,68 +142,157 @@ async def search():
     if limit > 50:
         limit = 50
 
-    name = f"%{name}%"
+    key = (" ".join(name.lower().split()), limit, offset)
+    cached = search_cache.get(key)
+    x_cache = "HIT" if cached else "MISS"
+    if cached is None:
+        generation = cache.library_generation
+        try:
+            results = await read(_search, name, limit, offset)
+        except:
+            return jsonify([])
+        cached = search_cache.set(key, json.dumps(results).encode(), generation)
 
-    try:
+    body, etag = cached
+    if request.if_none_match.contains(etag):
+        response = Response(b"", status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Cache"] = x_cache
+    return response
+
+
+def _search(name: str, limit: int, offset: int) -> List[dict]:
+    from ircradio.models import Song
+    q = Song.search_fts(name, columns=["title", "artist", "added_by"], limit=limit, offset=offset)
+    if q is None:
+        name = f"%{name}%"
         q = Song.select()
         q = q.where((Song.added_by ** name) | (Song.title ** name))
         q = q.order_by(Song.date_added.desc())
         q = q.limit(limit).offset(offset)
-        results = [{
-            "added_by": s.added_by,
-            "karma": s.karma,
-            "id": s.id,
-            "title": s.title,
-            "utube_id": s.utube_id,
-            "date_added": s.date_added.strftime("%Y-%m-%d")
-        } for s in q]
-    except:
-        return jsonify([])
+    return [{
+        "added_by": s.added_by,
+        "karma": s.karma,
+        "id": s.id,
+        "title": s.title,
+        "utube_id": s.utube_id,
+        "date_added": s.date_added.strftime("%Y-%m-%d")
+    } for s in q]
 
-    return jsonify(results)
 
-
-@app.route("/library")
-async def user_library():
-    from ircradio.models import Song
+def _library_args() -> Tuple[str, int]:
     name = request.args.get("name")
     if not name:
         abort(404)
 
     try:
-        by_date = Song.select().filter(Song.added_by == name)\
-            .order_by(Song.date_added.desc())
+        limit = min(int(request.args.get("limit", '200')), 1000)
+    except:
+        limit = 200
+    return name, limit
+
+
+@app.route("/library")
+async def user_library():
+    name, limit = _library_args()
+    date_cursor = request.args.get("date_cursor")
+    karma_cursor = request.args.get("karma_cursor")
+
+    try:
+        (by_date, date_next), (by_karma, karma_next) = await asyncio.gather(
+            AsyncSong.library(name, order="date", cursor=date_cursor, limit=limit),
+            AsyncSong.library(name, order="karma", cursor=karma_cursor, limit=limit))
     except:
-        by_date = []
+        abort(400)
 
-    if not by_date:
+    if not by_date and not date_cursor:
         abort(404)
 
+    return await stream_template("library.html", name=name, limit=limit,
+                                 by_date=by_date, date_cursor=date_cursor, date_next=date_next,
+                                 by_karma=by_karma, karma_cursor=karma_cursor, karma_next=karma_next)
+
+
+@app.route("/library.json")
+async def user_library_json():
+    # e.g: /library.json?name=test&order=karma&limit=50&cursor=...
+    name, limit = _library_args()
+    order = request.args.get("order", "date")
+    if order not in ["date", "karma"]:
+        abort(400)
+
+    try:
+        songs, cursor = await AsyncSong.library(name, order=order, cursor=request.args.get("cursor"), limit=limit)
+    except:
+        abort(400)
+
+    return jsonify({
+        "songs": [{
+            "karma": s.karma,
+            "id": s.id,
+            "title": s.title,
+            "utube_id": s.utube_id,
+            "date_added": s.date_added.strftime("%Y-%m-%d")
+        } for s in songs],
+        "next": cursor
+    })
+
+
+@app.route("/history.json")
+async def history_json():
+    # e.g: /history.json?limit=50&before=1234
     try:
-        by_karma = Song.select().filter(Song.added_by == name)\
-            .order_by(Song.karma.desc())
+        limit = min(int(request.args.get("limit", '50')), 500)
+        before = int(request.args["before"]) if "before" in request.args else None
     except:
-        by_karma = []
+        abort(400)
 
-    return await render_template("library.html", name=name, by_date=by_date, by_karma=by_karma)
+    plays = await AsyncPlay.history(before=before, limit=limit)
+    return jsonify({
+        "plays": [{
+            "id": p.id,
+            "utube_id": p.utube_id,
+            "title": p.song.title if p.song else None,
+            "added_by": p.added_by,
+            "started_at": p.started_at.isoformat(),
+            "listeners": p.listeners
+        } for p in plays],
+        "next": plays[-1].id if len(plays) == limit else None
+    })
+
+
+@app.route("/plays.json")
+async def plays_json():
+    # most played songs, e.g: /plays.json?limit=25 ; or plays of a submitter's songs, e.g: /plays.json?name=test
+    name = request.args.get("name")
+    if name:
+        return jsonify({"name": name, "plays": await AsyncPlay.count_by(name)})
+
+    try:
+        limit = min(int(request.args.get("limit", '25')), 500)
+    except:
+        limit = 25
+
+    songs = await AsyncPlay.most_played(limit)
+    return jsonify([{
+        "utube_id": s.utube_id,
+        "title": s.title,
+        "added_by": s.added_by,
+        "plays": s.plays
+    } for s in songs])
 
 
 @app.websocket("/ws")
 async def np():
-    last_song = ""
-    while True:
-        """get current song from history"""
-        history = Radio.history()
-        val = ""
-        if not history:
-            val = f"Nothing is playing?!"
-        else:
-            song = history[0]
-            val = song.title
-
-        if val != last_song:
-            data = json.dumps({"now_playing": val})
-            await websocket.send(f"{data}")
-
-        last_song = val
-        await asyncio.sleep(5)
+    """now playing updates, pushed by ircradio.websockets.producer"""
+    from ircradio.websockets import subscribe, unsubscribe
+    session = subscribe()
+    try:
+        while True:
+            frame = await session.get()
+            await websocket.send(frame)
+    finally:
+        unsubscribe(session)
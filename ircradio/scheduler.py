@@ -0,0 +1,200 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import Dict, List, Optional, Tuple
+from collections import deque
+import asyncio
+import random
+import os
+
+import settings
+
+
+class FenwickTree(object):
+    """Binary indexed tree over integer weights; O(log n) updates,
+    prefix sums and weighted lookups."""
+    def __init__(self, weights: List[int]):
+        self.size = len(weights)
+        self.tree = [0] + list(weights)
+        for i in range(1, self.size + 1):
+            j = i + (i & -i)
+            if j <= self.size:
+                self.tree[j] += self.tree[i]
+        self.total = sum(weights)
+        self._top = 1 << (self.size.bit_length() - 1) if self.size else 0
+
+    def add(self, idx: int, delta: int):
+        self.total += delta
+        i = idx + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, value: int) -> int:
+        """index of the item the cumulative weight `value` falls in"""
+        pos = 0
+        step = self._top
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and self.tree[nxt] <= value:
+                pos = nxt
+                value -= self.tree[nxt]
+            step >>= 1
+        return pos
+
+
+def artist(title: str) -> Optional[str]:
+    """'Artist - Title' convention, as used by the FTS index"""
+    if " - " in title:
+        return title.split(" - ", 1)[0].strip().lower()
+
+
+class Rotation(object):
+    """Picks autoplay tracks, weighted by karma. Recently played songs
+    sit out a no-repeat window (weight 0), and picks avoid the artist and
+    submitter of the last few tracks. Keeps LiquidSoap's `autoplay`
+    request queue topped up; the static playlist remains the fallback."""
+    def __init__(self, window: int = 50, separation: int = 3, queue_size: int = 1,
+                 interval: float = 5, tries: int = 8):
+        self.window = window
+        self.separation = separation
+        self.queue_size = queue_size
+        self.interval = interval
+        self.tries = tries
+
+        self.uids: List[str] = []
+        self.slots: Dict[str, int] = {}
+        self.meta: List[Tuple[str, Optional[str]]] = []  # (added_by, artist)
+        self.weights: List[int] = []
+        self.tree = FenwickTree([])
+        self.digest = None
+
+        self.cooling = deque()  # no-repeat window, oldest first
+        self.recent = deque(maxlen=separation)  # (added_by, artist)
+
+    @staticmethod
+    def weight(karma: int) -> int:
+        return max(karma, 0) + 1
+
+    def _build(self, rows: List[Tuple[str, str, str, int]]) -> tuple:
+        uids = [r[0] for r in rows]
+        slots = {uid: i for i, uid in enumerate(uids)}
+        weights = [self.weight(r[3]) for r in rows]
+        meta = [(r[2], artist(r[1])) for r in rows]
+        cooling = deque(uid for uid in list(self.cooling) if uid in slots)
+        effective = list(weights)
+        for uid in cooling:
+            effective[slots[uid]] = 0
+        return uids, slots, weights, meta, FenwickTree(effective), cooling
+
+    def load(self, rows: List[Tuple[str, str, str, int]]):
+        """rows as returned by `Playlist.playable()`"""
+        self._swap(self._build(rows))
+
+    def _swap(self, built: tuple):
+        self.uids, self.slots, self.weights, self.meta, self.tree, self.cooling = built
+
+    def _effective(self, slot: int) -> int:
+        return 0 if self.uids[slot] in self.cooling else self.weights[slot]
+
+    def update(self, utube_id: str, karma: int):
+        """karma changed (vote)"""
+        slot = self.slots.get(utube_id)
+        if slot is None:
+            return
+        before = self._effective(slot)
+        self.weights[slot] = self.weight(karma)
+        delta = self._effective(slot) - before
+        if delta:
+            self.tree.add(slot, delta)
+
+    def played(self, utube_id: str):
+        """start the no-repeat window for a song, picked or requested"""
+        slot = self.slots.get(utube_id)
+        if slot is None or utube_id in self.cooling:
+            return
+
+        self.recent.append(self.meta[slot])
+        self.tree.add(slot, -self.weights[slot])
+        self.cooling.append(utube_id)
+        while len(self.cooling) > self.window:
+            uid = self.cooling.popleft()
+            if uid in self.slots:
+                self.tree.add(self.slots[uid], self.weights[self.slots[uid]])
+
+    def pick(self) -> Optional[str]:
+        if self.tree.total <= 0:
+            return None
+
+        added_bys = {m[0] for m in self.recent}
+        artists = {m[1] for m in self.recent if m[1]}
+        fallback = None
+        for _ in range(self.tries):
+            slot = self.tree.find(random.randrange(self.tree.total))
+            added_by, _artist = self.meta[slot]
+            if _artist in artists:
+                fallback = fallback if fallback is not None else slot
+                continue
+            if added_by in added_bys:
+                # artist separation matters more than submitter separation
+                fallback = slot
+                continue
+            break
+        else:
+            slot = fallback
+
+        uid = self.uids[slot]
+        self.played(uid)
+        return uid
+
+    async def reload(self):
+        from ircradio.database import read
+        from ircradio.library import Playlist
+        # query and build off the event loop, swap in on it
+        self._swap(await read(lambda: self._build(Playlist.playable())))
+
+    async def top_up(self):
+        from ircradio.factory import now_playing
+        from ircradio.radio import Radio
+        queued = await Radio.command("autoplay.queue")
+        queued = [q for q in queued.split(b"\r\n") if q and q != b"END"]
+        rids = queued[0].decode().split(" ") if queued else []
+
+        # the head of the request queue may be the song currently playing
+        song = now_playing.song if now_playing else None
+        if rids and song:
+            meta = await Radio.command(f"request.metadata {rids[0]}")
+            paths = Radio.filenames_from_strlist(meta.decode(errors="ignore").split("\n"))
+            if paths and paths[0] == song.filepath:
+                rids = rids[1:]
+        queued = len(rids)
+
+        for _ in range(self.queue_size - queued):
+            uid = self.pick()
+            if not uid:
+                return
+            await Radio.command(f"autoplay.push {os.path.join(settings.dir_music, f'{uid}.ogg')}")
+
+    async def run(self):
+        from ircradio.factory import app, playlist, now_playing
+        version = 0
+        while True:
+            try:
+                if playlist.digest != self.digest:
+                    digest = playlist.digest
+                    await self.reload()
+                    self.digest = digest
+
+                if now_playing.version != version:
+                    version = now_playing.version
+                    if now_playing.song:
+                        self.played(now_playing.song.utube_id)
+
+                await self.top_up()
+            except Exception as ex:
+                app.logger.error(f"rotation: {ex}")
+
+            try:
+                await now_playing.wait_for_change(version, timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
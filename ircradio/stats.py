@@ -0,0 +1,77 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import Dict, Optional
+from datetime import datetime
+import asyncio
+import os
+
+import settings
+
+# set by the last reconciliation
+reconciled: Optional[datetime] = None
+
+
+def file_sizes(directory: str) -> Dict[str, int]:
+    """utube_id -> bytes, for the .ogg files in `directory`"""
+    sizes = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            uid, _, ext = entry.name.partition(".")
+            if ext == "ogg" and entry.is_file():
+                sizes[uid] = entry.stat().st_size
+    return sizes
+
+
+def reconcile(sizes: Dict[str, int] = None) -> bool:
+    """Recompute LibraryStat from the song table and the music directory,
+    returns True when the incremental totals had drifted"""
+    global reconciled
+    from ircradio.models import db, Song, LibraryStat
+    if sizes is None:
+        sizes = file_sizes(settings.dir_music)
+
+    rows: Dict[str, dict] = {}
+    with db.atomic():
+        for uid, added_by, duration in Song.select(Song.utube_id, Song.added_by, Song.duration).tuples():
+            # same grouping as the NOCASE primary key
+            row = rows.setdefault(added_by.lower(), {
+                "added_by": added_by, "songs": 0, "duration": 0, "bytes": 0})
+            row["songs"] += 1
+            row["duration"] += int(duration or 0)
+            row["bytes"] += sizes.get(uid, 0)
+
+        current = {r["added_by"].lower(): r for r in LibraryStat.select().dicts()}
+        drifted = {k: (v["songs"], v["duration"], v["bytes"]) for k, v in current.items() if v["songs"]} != \
+                  {k: (v["songs"], v["duration"], v["bytes"]) for k, v in rows.items()}
+        if drifted:
+            LibraryStat.delete().execute()
+            rows = list(rows.values())
+            for i in range(0, len(rows), 500):
+                LibraryStat.insert_many(rows[i:i + 500]).execute()
+
+    reconciled = datetime.now()
+    return drifted
+
+
+async def summary() -> dict:
+    from ircradio.database import read
+    from ircradio.models import LibraryStat
+    totals = await read(LibraryStat.totals)
+    totals["reconciled"] = reconciled.isoformat() if reconciled else None
+    return totals
+
+
+async def reconciler(interval: int):
+    """The directory scan runs on a reader thread, the recount on the
+    writer, so it is serialized with the incremental updates"""
+    from ircradio.factory import app
+    from ircradio.database import read, write
+    while True:
+        try:
+            sizes = await read(file_sizes, settings.dir_music)
+            if await write(reconcile, sizes):
+                app.logger.info("library stats reconciled (had drifted)")
+        except Exception as ex:
+            app.logger.error(f"library stats: {ex}")
+        await asyncio.sleep(interval)
@@ -1,7 +1,7 @@
 # SPDX-License-Identifier: BSD-3-Clause
 # Copyright (c) 2021, dsc@xmr.pm
 
-from typing import List, Optional, Union
+from typing import List, Optional, Union, Dict, Tuple
 import re
 import shutil
 import os
@@ -168,19 +168,55 @@ def liquidsoap_check_symlink():
         sys.exit()
 
 
-async def httpget(url: str, json=True, timeout: int = 5, raise_for_status=True, verify_tls=True):
+# (url, json) -> (expires, result), see httpget(cache_ttl=)
+httpget_cache: Dict[Tuple[str, bool], Tuple[float, object]] = {}
+
+
+def http_session() -> aiohttp.ClientSession:
+    """Process-wide session, pools keep-alive connections per host"""
+    connector = aiohttp.TCPConnector(
+        limit=settings.http_max_connections,
+        limit_per_host=settings.http_max_connections_per_host,
+        keepalive_timeout=30)
+    return aiohttp.ClientSession(connector=connector)
+
+
+async def httpget(url: str, json=True, timeout: int = 5, raise_for_status=True, verify_tls=True,
+                  cache_ttl: float = 0):
+    from ircradio.factory import http
+    if cache_ttl:
+        cached = httpget_cache.get((url, json))
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
     headers = {"User-Agent": random_agent()}
     opts = {"timeout": aiohttp.ClientTimeout(total=timeout)}
 
-    async with aiohttp.ClientSession(**opts) as session:
-        async with session.get(url, headers=headers, ssl=verify_tls) as response:
+    # outside of the app (e.g. cli) there is no shared session
+    session = http if http and not http.closed else aiohttp.ClientSession()
+    try:
+        async with session.get(url, headers=headers, ssl=verify_tls, **opts) as response:
             if raise_for_status:
                 response.raise_for_status()
 
             result = await response.json() if json else await response.text()
             if result is None or (isinstance(result, str) and result == ''):
                 raise Exception("empty response from request")
-            return result
+    finally:
+        if session is not http:
+            await session.close()
+
+    if cache_ttl:
+        httpget_cache[(url, json)] = (time.monotonic() + cache_ttl, result)
+    return result
+
+
+def human_bytes(size: int) -> str:
+    """du -h style"""
+    for unit in ["B", "K", "M", "G", "T"]:
+        if abs(size) < 1024 or unit == "T":
+            return f"{size:.1f}{unit}" if unit != "B" else f"{size}B"
+        size /= 1024
 
 
 def random_agent():
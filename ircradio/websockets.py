@@ -0,0 +1,88 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2021, dsc@xmr.pm
+
+from typing import Optional
+import asyncio
+import json
+
+from ircradio.models import Song
+from ircradio import metrics
+
+# last frame sent, new clients receive it immediately
+current_frame: Optional[str] = None
+# frames dropped for slow clients, all sessions
+dropped = 0
+
+
+class WebsocketSession(object):
+    """Per-client bounded outbox; when a slow client falls behind
+    the oldest frames are dropped."""
+    def __init__(self, maxsize: int = 8):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def put(self, frame: str):
+        global dropped
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+            dropped += 1
+        self.queue.put_nowait(frame)
+
+    async def get(self) -> str:
+        return await self.queue.get()
+
+
+def _clients() -> int:
+    from ircradio.factory import websocket_sessions
+    return len(websocket_sessions)
+
+
+metrics.Callback("ircradio_websocket_clients", "Connected /ws clients", _clients)
+metrics.Callback("ircradio_websocket_dropped_frames_total", "Frames dropped for slow /ws clients",
+                 lambda: dropped, type="counter")
+
+
+def subscribe() -> WebsocketSession:
+    from ircradio.factory import websocket_sessions
+    session = WebsocketSession()
+    if current_frame:
+        session.put(current_frame)
+    websocket_sessions.add(session)
+    return session
+
+
+def unsubscribe(session: WebsocketSession):
+    from ircradio.factory import websocket_sessions
+    websocket_sessions.discard(session)
+
+
+def broadcast(frame: str):
+    global current_frame
+    from ircradio.factory import websocket_sessions
+    current_frame = frame
+    for session in websocket_sessions:
+        session.put(frame)
+
+
+def now_playing_frame(song: Optional[Song]) -> str:
+    val = song.title if song else "Nothing is playing?!"
+    return json.dumps({"now_playing": val})
+
+
+async def producer():
+    """serialize once per track change, fan out to all sessions"""
+    from ircradio.factory import app, now_playing
+    version = None
+    while True:
+        try:
+            if version is not None:
+                await now_playing.wait_for_change(version)
+            version = now_playing.version
+
+            frame = now_playing_frame(now_playing.song)
+            if frame != current_frame:
+                broadcast(frame)
+        except Exception as ex:
+            app.logger.error(f"websocket producer: {ex}")
+            await asyncio.sleep(1)
@@ -6,34 +6,37 @@ import os
 import sys
 import asyncio
 import re
-from typing import Optional
+import time
+from typing import Optional, Callable
 
 import settings
+from ircradio import loudness, metrics
 
 
 class YouTube:
     @staticmethod
-    async def download(utube_id: str, added_by: str) -> Optional['Song']:
-        from ircradio.factory import app
-        from ircradio.models import Song
+    async def download(utube_id: str, added_by: str, progress: Callable[[float], None] = None) -> Optional['Song']:
+        from ircradio.factory import app, music_index
+        from ircradio.database import AsyncSong, AsyncFileMeta
 
         output = f"{settings.dir_music}/{utube_id}.ogg"
-        song = Song.by_uid(utube_id)
+        song = await AsyncSong.by_uid(utube_id)
         if song:
             if not os.path.exists(output):
                 # exists in db but not on disk; remove from db
-                Song.delete().where(Song.utube_id == utube_id).execute()
+                await AsyncSong.delete(utube_id)
             else:
                 raise Exception("Song already exists.")
 
         if os.path.exists(output):
-            song = Song.by_uid(utube_id)
+            song = await AsyncSong.by_uid(utube_id)
             if not song:
                 # exists on disk but not in db; add to db
-                return Song.from_filepath(output)
+                return await AsyncSong.from_filepath(output)
 
             raise Exception("Song already exists.")
 
+        started = time.perf_counter()
         try:
             proc = await asyncio.create_subprocess_exec(
                 *["yt-dlp",
@@ -44,41 +47,89 @@ class YouTube:
                     "--max-filesize", "30M",
                     "--extract-audio",
                     "--audio-format", "vorbis",
+                    "--newline",
                     "-o", f"{settings.dir_music}/%(id)s.ogg",
                     f"https://www.youtube.com/watch?v={utube_id}"],
                 stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE)
-            result = await proc.communicate()
-            result = result[0].decode()
-            if "100%" not in result:
+                stderr=asyncio.subprocess.STDOUT)
+
+            completed = False
+            try:
+                async for line in proc.stdout:
+                    line = line.decode(errors="ignore")
+                    match = re.search(r"\[download\]\s+(\d+(?:\.\d+)?)%", line)
+                    if not match:
+                        continue
+                    percentage = float(match.group(1))
+                    if progress:
+                        progress(percentage)
+                    if percentage >= 100:
+                        completed = True
+                await proc.wait()
+            except asyncio.CancelledError:
+                proc.kill()
+                raise
+
+            if not completed:
                 raise Exception("download did not complete")
+            metrics.download_seconds.observe(time.perf_counter() - started)
+        except asyncio.CancelledError:
+            raise
         except Exception as ex:
             msg = f"download failed: {ex}"
             app.logger.error(msg)
             raise Exception(msg)
 
         try:
-            metadata = YouTube.metadata_from_filepath(output)
+            metadata = await AsyncFileMeta.metadata(output)
             if not metadata:
                 raise Exception("failed to fetch metadata")
 
             if metadata['duration'] > settings.liquidsoap_max_song_duration:
-                Song.delete_song(utube_id)
+                await AsyncSong.delete_song(utube_id)
                 raise Exception(f"Song exceeded duration of {settings.liquidsoap_max_song_duration} seconds")
 
-            song = Song.create(
+            song = await AsyncSong.create(
                 duration=metadata['duration'],
                 title=metadata['name'],
                 added_by=added_by,
                 karma=5,
                 utube_id=utube_id)
-            return song
+            if music_index:
+                music_index.add(output)
         except Exception as ex:
             app.logger.error(f"{ex}")
             raise
 
+        try:
+            measured = await loudness.measure(utube_id)
+            if measured:
+                song.loudness, song.peak = measured
+        except Exception as ex:
+            app.logger.error(f"loudness analysis failed for {utube_id}: {ex}")
+        return song
+
     @staticmethod
     def metadata_from_filepath(filepath: str):
+        """Cached by (path, mtime, size), see FileMeta"""
+        from ircradio.models import FileMeta
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            stat = None
+
+        if stat:
+            metadata = FileMeta.lookup(filepath, mtime=stat.st_mtime, size=stat.st_size)
+            if metadata:
+                return metadata
+
+        metadata = YouTube.parse_metadata(filepath)
+        if metadata and stat:
+            FileMeta.store(filepath, mtime=stat.st_mtime, size=stat.st_size, metadata=metadata)
+        return metadata
+
+    @staticmethod
+    def parse_metadata(filepath: str):
         from ircradio.factory import app
         import mutagen
 
@@ -124,9 +175,28 @@ class YouTube:
 
     @staticmethod
     async def update_loop():
+        """Upgrade yt-dlp every `ytdlp_update_interval` seconds. The last
+        check is kept as the mtime of a stamp file, so restarts don't
+        upgrade again."""
+        from ircradio.factory import app
+        stamp = os.path.join(settings.cwd, "data", ".ytdlp_updated")
         while True:
-            await YouTube.update()
-            await asyncio.sleep(3600)
+            try:
+                last = os.path.getmtime(stamp)
+            except OSError:
+                last = 0
+            due = last + settings.ytdlp_update_interval - time.time()
+            if due > 0:
+                await asyncio.sleep(due)
+                continue
+
+            try:
+                await YouTube.update()
+                with open(stamp, "a"):
+                    os.utime(stamp)
+            except Exception as ex:
+                app.logger.error(f"yt-dlp update: {ex}")
+                await asyncio.sleep(settings.ytdlp_update_interval)
 
     @staticmethod
     async def update():
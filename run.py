@@ -21,7 +21,8 @@ def cli():
 @cli.command(name="generate")
 def cli_generate_configs(*args, **kwargs):
     """Generate icecast2/liquidsoap configs and systemd service files"""
-    from ircradio.utils import jinja2_render, write_file_sync, systemd_servicefile
+    from ircradio.utils import jinja2_render, write_file_sync, systemd_servicefile, liquidsoap_check_symlink
+    liquidsoap_check_symlink()
 
     templates_dir = os.path.join(settings.cwd, "ircradio", "templates")
 
@@ -48,9 +49,19 @@ def cli_generate_configs(*args, **kwargs):
                              icecast2_mount=settings.icecast2_mount,
                              liquidsoap_description=settings.liquidsoap_description,
                              icecast2_source_password=settings.icecast2_source_password,
-                             dir_music=settings.dir_music)
+                             dir_music=settings.dir_music,
+                             liquidsoap_playlist=settings.liquidsoap_playlist,
+                             liquidsoap_normalize=settings.liquidsoap_normalize)
     write_file_sync(fn=os.path.join(settings.cwd, "data", "soap.liq"), data=template.encode())
 
+    # initial playlist, kept up to date by the web-if
+    import asyncio
+    from ircradio.factory import _setup_database
+    from ircradio.library import Playlist
+    app = create_app()
+    asyncio.run(_setup_database(app))
+    Playlist(settings.liquidsoap_playlist).write()
+
     # cross.liq
     path_liquidsoap_cross_template = os.path.join(templates_dir, "cross.liq.jinja2")
     path_liquidsoap_cross = os.path.join(settings.cwd, "data", "cross.liq")
@@ -82,10 +93,106 @@ def cli_generate_configs(*args, **kwargs):
     print(f"written config files to {os.path.join(settings.cwd, 'data')}")
 
 
+@cli.command(name="import")
+@click.option("--workers", type=int, default=None, help="metadata extraction processes (default: all cores)")
+@click.option("--loudness", is_flag=True, help="also measure loudness and write ReplayGain tags (slow, modifies files)")
+def cli_import(workers: int = None, loudness: bool = False, **kwargs):
+    """Import songs from the music directory that are not in the database"""
+    _library_import(rescan=False, workers=workers, loudness=loudness)
+
+
+@cli.command(name="rescan")
+@click.option("--workers", type=int, default=None, help="metadata extraction processes (default: all cores)")
+@click.option("--loudness", is_flag=True, help="also measure loudness and write ReplayGain tags (slow, modifies files)")
+def cli_rescan(workers: int = None, loudness: bool = False, **kwargs):
+    """Like import, but also remove songs whose file is gone"""
+    _library_import(rescan=True, workers=workers, loudness=loudness)
+
+
+def _library_import(rescan: bool, workers: int = None, loudness: bool = False):
+    import asyncio
+    from ircradio.factory import create_app, _setup_database
+    from ircradio.library import import_library, Playlist
+    app = create_app()
+    asyncio.run(_setup_database(app))
+    import_library(rescan=rescan, workers=workers)
+    if loudness:
+        from ircradio.loudness import backfill
+        backfill(workers=workers)
+
+    # the web-if runs in another process; update the playlist from here
+    if Playlist(settings.liquidsoap_playlist).write():
+        asyncio.run(_playlist_reload())
+
+
+async def _playlist_reload():
+    from ircradio.liquidsoap import LiquidSoapClient, LiquidSoapError
+    client = LiquidSoapClient(settings.liquidsoap_host, settings.liquidsoap_port,
+                              pool_size=1, timeout=settings.liquidsoap_timeout, retries=1)
+    try:
+        await client.command("playlist.reload")
+    except LiquidSoapError as ex:
+        print(f"playlist written, but could not reload liquidsoap: {ex}")
+    finally:
+        await client.close()
+
+
+@cli.command(name="loudness")
+@click.option("--workers", type=int, default=None, help="ffmpeg analysis processes (default: all cores)")
+def cli_loudness(workers: int = None, **kwargs):
+    """Measure loudness and write ReplayGain tags for songs that have none yet"""
+    import asyncio
+    from ircradio.factory import create_app, _setup_database
+    from ircradio.loudness import backfill
+    app = create_app()
+    asyncio.run(_setup_database(app))
+    backfill(workers=workers)
+
+
+@cli.command(name="bench")
+@click.option("--songs", type=int, default=10000, help="synthetic library size")
+@click.option("--requests", type=int, default=2000, help="requests per scenario")
+@click.option("--concurrency", type=int, default=16)
+@click.option("--clients", type=int, default=200, help="websocket clients")
+@click.option("--sessions", type=int, default=3000, help="/ws sessions for the fan-out case (no websocket server)")
+@click.option("--rotation-songs", type=int, default=100000, help="in-memory library size for the rotation case")
+def cli_bench(songs: int, requests: int, concurrency: int, clients: int, sessions: int, rotation_songs: int,
+              **kwargs):
+    """Benchmark the web-if against fake liquidsoap/icecast servers"""
+    import asyncio
+    from ircradio.bench import run
+    asyncio.run(run(songs=songs, requests=requests, concurrency=concurrency, clients=clients,
+                    sessions=sessions, rotation_songs=rotation_songs))
+
+
+@cli.command(name="fakes")
+@click.option("--track-seconds", type=float, default=30, help="advance to the next track every N seconds")
+def cli_fakes(track_seconds: float, **kwargs):
+    """Run fake liquidsoap (telnet) and icecast (status-json.xsl) servers, for development"""
+    import asyncio
+    from ircradio.fakes import FakeLiquidSoap, FakeIceCast
+
+    async def main():
+        library = [os.path.join(settings.dir_music, fn) for fn in os.listdir(settings.dir_music)
+                   if fn.endswith(".ogg")]
+        liquidsoap = FakeLiquidSoap(library, host=settings.liquidsoap_host, port=settings.liquidsoap_port,
+                                    track_seconds=track_seconds)
+        icecast = FakeIceCast(host=settings.icecast2_bind_host, port=settings.icecast2_bind_port)
+        await liquidsoap.start()
+        await icecast.start()
+        print(f"fake liquidsoap on {liquidsoap.host}:{liquidsoap.port} ({len(library)} tracks), "
+              f"fake icecast on {icecast.host}:{icecast.port}")
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
 @cli.command(name="webdev")
 def webdev(*args, **kwargs):
     """Run the web-if, for development purposes"""
     from ircradio.factory import create_app
+    from ircradio.utils import liquidsoap_check_symlink
+    liquidsoap_check_symlink()
     app = create_app()
     app.run(settings.host, port=settings.port, debug=settings.debug, use_reloader=False)
 